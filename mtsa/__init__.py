@@ -5,4 +5,7 @@ from .features import *
 from .model_selection import *
 from .plotters import *
 from .utils import *
+from .corpus import *
+from .ragged import *
+from .manifest import *
 
@@ -0,0 +1,227 @@
+"""Contiguous memory-mapped corpus of decoded clips."""
+
+import os
+import glob
+import json
+import argparse
+import numpy as np
+from functools import partial
+from sklearn.base import BaseEstimator, TransformerMixin
+from mtsa.utils import (
+    NATIVE,
+    get_files_from_path_classes,
+    get_sampling_rate,
+    iter_chunks,
+    load_audio,
+    ordered_map,
+)
+from mtsa.ragged import RaggedArray, stack_clips
+
+SAMPLES = "samples.bin"
+INDEX = "index.npz"
+META = "meta.json"
+INT16_SCALE = 32767.0
+
+def get_paths_from_root(path):
+    """A machine ID directory holds normal/ and abnormal/; a machine type directory holds machine IDs."""
+    if os.path.isdir(os.path.join(path, "normal")):
+        return [path]
+    return sorted(p for p in glob.glob(os.path.join(path, f'*{os.sep}')) if os.path.isdir(os.path.join(p, "normal")))
+
+def pack_corpus(path, output, sampling_rate=None, mono=True, dtype="float32", n_jobs=None):
+    """
+    Decodes every clip under path (a machine ID or a machine type directory) into one contiguous file.
+    Clips are appended one after the other, with channels interleaved when mono=False, and an index
+    with the offsets, lengths, labels and source files of the clips is written next to it.
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.dtype("float32"), np.dtype("int16")):
+        raise ValueError(f"dtype must be float32 or int16, got {dtype}")
+    paths = get_paths_from_root(path)
+    files, y, groups = [], [], []
+    for group, p in enumerate(paths):
+        X_p, y_p = get_files_from_path_classes(p)
+        files.extend(X_p)
+        y.extend(y_p)
+        groups.extend([group] * len(X_p))
+
+    os.makedirs(output, exist_ok=True)
+    get_array = partial(load_audio, sampling_rate=sampling_rate, mono=mono)
+    lengths = np.zeros(len(files), dtype=np.int64)
+    n_channels = None
+    with open(os.path.join(output, SAMPLES), "wb") as fh:
+        for i, s in enumerate(ordered_map(get_array, files, n_jobs=n_jobs)):
+            s = np.atleast_2d(s)
+            if n_channels is None:
+                n_channels = len(s)
+            elif len(s) != n_channels:
+                raise ValueError(f"{files[i]} has {len(s)} channels, expected {n_channels}")
+            if dtype == np.int16:
+                s = np.clip(np.round(s * INT16_SCALE), -INT16_SCALE, INT16_SCALE)
+            fh.write(np.ascontiguousarray(s.T, dtype=dtype).tobytes())
+            lengths[i] = s.shape[-1]
+
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    np.savez(
+        os.path.join(output, INDEX),
+        offsets=offsets,
+        y=np.array(y, dtype=float),
+        groups=np.array(groups, dtype=np.int64),
+        files=np.array(files, dtype=str),
+        )
+    meta = {
+        "dtype": dtype.name,
+        "n_channels": n_channels or 1,
+        "mono": mono,
+        "sampling_rate": sampling_rate,
+        "paths": paths,
+    }
+    with open(os.path.join(output, META), "w") as fh:
+        json.dump(meta, fh)
+    return Corpus(output)
+
+
+class Corpus():
+    """
+    Read-only view over a corpus written by pack_corpus. The samples are memory-mapped, so every
+    process opening the same corpus shares one page-cached copy, and clips are sliced without copies.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        with open(os.path.join(path, META)) as fh:
+            self.meta = json.load(fh)
+        with np.load(os.path.join(path, INDEX)) as index:
+            self.offsets = index["offsets"]
+            self.y = index["y"]
+            self.groups = index["groups"]
+            self.files = index["files"]
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.n_channels = self.meta["n_channels"]
+        shape = (int(self.offsets[-1]),)
+        if not self.meta["mono"]:
+            shape = shape + (self.n_channels,)
+        self.samples = np.memmap(os.path.join(path, SAMPLES), dtype=self.dtype, mode="r", shape=shape)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def sampling_rate(self):
+        """The rate the clips were decoded at by pack_corpus."""
+        f = self.files[0] if len(self.files) else None
+        if self.meta["sampling_rate"] == NATIVE and f is None:
+            return None
+        return get_sampling_rate(f, self.meta["sampling_rate"])
+
+    @property
+    def X(self):
+        """Clip indices, usable wherever a list of files is used to split a dataset."""
+        return np.arange(len(self))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _decode(self, s):
+        if self.dtype == np.int16:
+            return (s / INT16_SCALE).astype(np.float32)
+        return s
+
+    def __getitem__(self, i):
+        s = self.samples[self.offsets[i]:self.offsets[i + 1]]
+        return self._decode(s.T)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def get_indices(self, X):
+        """Maps file paths (or clip indices) to clip indices."""
+        X = np.asarray(X)
+        if np.issubdtype(X.dtype, np.integer):
+            return X
+        if getattr(self, "_lookup", None) is None:
+            self._lookup = {f: i for i, f in enumerate(self.files)}
+        return np.array([self._lookup[f] for f in X], dtype=np.int64)
+
+    def get_clips(self, indices):
+        indices = np.asarray(indices)
+        lengths = self.lengths[indices]
+        contiguous = len(indices) > 0 and np.all(np.diff(indices) == 1)
+        if contiguous and np.all(lengths == lengths[0]):
+            # consecutive clips of the same length are a reshape of the samples, not a copy
+            start, end = self.offsets[indices[0]], self.offsets[indices[-1] + 1]
+            s = self.samples[start:end].reshape((len(indices), lengths[0]) + self.samples.shape[1:])
+            return self._decode(np.swapaxes(s, 1, -1) if s.ndim > 2 else s)
+        return stack_clips((self[i] for i in indices), n=len(indices))
+
+
+class Corpus2Array(BaseEstimator, TransformerMixin):
+    """
+     Replacement of Wav2Array reading clips from a corpus written by pack_corpus, 
+     e.g. the corpus option of Hitachi, MFCCMix, GANF and RANSynCoders.
+     X holds either file paths, as returned by files_train_test_split, or clip indices.
+     Clips are not resampled: sampling_rate=NATIVE takes the rate of the corpus, any other rate must be that rate.
+     The rate is recorded as sampling_rate_ by fit, and chunk_size and dtype are those of Wav2Array.
+    """
+
+    def __init__(self, path, sampling_rate=NATIVE, chunk_size=None, dtype="float32"):
+        self.path = path
+        self.sampling_rate = sampling_rate
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+
+    @property
+    def corpus(self):
+        if getattr(self, "_corpus", None) is None:
+            self._corpus = Corpus(self.path)
+        return self._corpus
+
+    def __getstate__(self):
+        # the memmap is reopened by each worker instead of being pickled
+        state = self.__dict__.copy()
+        state.pop("_corpus", None)
+        return state
+
+    def fit(self, X, y=None, **fit_params):
+        sampling_rate = self.corpus.sampling_rate
+        if self.sampling_rate != NATIVE and get_sampling_rate(None, self.sampling_rate) != sampling_rate:
+            raise ValueError(
+                f"the corpus {self.path} holds clips at {sampling_rate} Hz, not {get_sampling_rate(None, self.sampling_rate)} Hz: "
+                "pack it again at that rate, or set sampling_rate to NATIVE")
+        self.sampling_rate_ = sampling_rate
+        return self
+
+    def get_clips(self, indices):
+        Xt = self.corpus.get_clips(indices)
+        if isinstance(Xt, RaggedArray):
+            return RaggedArray(Xt.data.astype(self.dtype, copy=False), Xt.offsets)
+        return Xt.astype(self.dtype, copy=False)
+
+    def transform(self, X, y=None, **fit_params):
+        indices = self.corpus.get_indices(X)
+        if self.chunk_size:
+            return (self.get_clips(chunk) for chunk in iter_chunks(indices, self.chunk_size))
+        return self.get_clips(indices)
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--sampling_rate', type=int)
+    parser.add_argument('--multichannel', action='store_true')
+    parser.add_argument('--dtype', choices=['float32', 'int16'], default='float32')
+    parser.add_argument('--n_jobs', type=int)
+    args = parser.parse_args(argv)
+    pack_corpus(
+        args.path,
+        args.output,
+        sampling_rate=args.sampling_rate,
+        mono=not args.multichannel,
+        dtype=args.dtype,
+        n_jobs=args.n_jobs,
+        )
+
+if __name__ == "__main__":
+    _main()
@@ -1,5 +1,53 @@
 import numpy as np
 import abc
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def get_triu_indices(n, k=1):
+    return np.triu_indices(n, k=k)
+
+def get_triu(C, k=1):
+    """Upper triangles of a batch of matrices shaped (..., n, n), flattened into (..., n * (n - 1) / 2) for k=1."""
+    rows, cols = get_triu_indices(C.shape[-1], k)
+    return C[..., rows, cols]
+
+def get_covariances(X):
+    """
+    Means and covariance matrices (normalized by n_frames) of a batch of signals shaped (n_clips, n_features, n_frames),
+    with one batched matmul.
+    """
+    m = np.mean(X, axis=-1, dtype=np.float64)
+    D = X - m[..., np.newaxis]
+    return m, np.matmul(D, np.swapaxes(D, -1, -2)) / X.shape[-1]
+
+def rank(X):
+    """
+    Ranks (from 1) of X along its last axis, tied values getting the average of their ranks, 
+    as scipy.stats.rankdata(X, axis=-1), for a whole batch with one sort.
+    """
+    X = np.asarray(X)
+    n = X.shape[-1]
+    # ties are averaged over their run, so the order among them does not matter
+    order = np.argsort(X, axis=-1)
+    X_sorted = np.take_along_axis(X, order, axis=-1)
+    positions = np.broadcast_to(np.arange(n), X.shape)
+    # a run of tied values spans from its first to its last position in sorted order
+    first = np.ones(X.shape, dtype=bool)
+    first[..., 1:] = X_sorted[..., 1:] != X_sorted[..., :-1]
+    last = np.ones(X.shape, dtype=bool)
+    last[..., :-1] = first[..., 1:]
+    start = np.maximum.accumulate(np.where(first, positions, 0), axis=-1)
+    end = np.flip(np.minimum.accumulate(np.flip(np.where(last, positions, n - 1), axis=-1), axis=-1), axis=-1)
+    ranks = np.empty(X.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, (start + end) / 2 + 1, axis=-1)
+    return ranks
+
+def covariance_to_correlation(cov):
+    """Correlation matrices and standard deviations of a batch of covariance matrices, as np.corrcoef."""
+    std = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        C = cov / std[..., :, np.newaxis] / std[..., np.newaxis, :]
+    return np.clip(C, -1, 1), std
 
 class CorrelationNetwork(abc.ABC):
     """
@@ -9,12 +57,25 @@ class CorrelationNetwork(abc.ABC):
     def get_correlation(self, X: np.ndarray):
         """Implement correlation"""
 
+    def get_correlations(self, X: np.ndarray):
+        """Correlation matrices of a batch of clips shaped (n_clips, n_features, n_frames)."""
+        return np.array([self.get_correlation(Xi) for Xi in X])
+
+    def get_features(self, X: np.ndarray):
+        """Upper triangles of the correlation matrices of a batch of clips, shaped (n_clips, n_features * (n_features - 1) / 2)."""
+        return get_triu(self.get_correlations(X))
+
 class PearsonCorrelationNetwork(CorrelationNetwork):
 
     def get_correlation(self, X : np.ndarray):
         C = np.corrcoef(X, rowvar=True)
         return C
 
+    def get_correlations(self, X: np.ndarray):
+        _, cov = get_covariances(X)
+        C, _ = covariance_to_correlation(cov)
+        return C
+
 class DynamicCorrelationNetwork(CorrelationNetwork):
 
     def get_correlation(self, X : np.ndarray):
@@ -30,10 +91,115 @@ class DynamicCorrelationNetwork(CorrelationNetwork):
         m = np.mean(X, axis=0)
         D = X - m
         return 1/len(D) * D.T.dot(D)
+
+    def get_correlations(self, X: np.ndarray):
+        x_min = np.min(X, axis=-1, keepdims=True)
+        x_max = np.max(X, axis=-1, keepdims=True)
+        X = (X - x_min) / (x_max - x_min)
+        X = 2*X - 1
+        _, cov = get_covariances(X)
+        return cov
     
-import scipy.stats as st
 class SpearmanCorrelationNetwork(CorrelationNetwork):
+    """
+    Spearman correlation between the rows of X (e.g., mfccs), that is, the Pearson correlation of their ranks 
+    along the frames.
+    """
 
     def get_correlation(self, X : np.ndarray):
-        rho, pval = st.spearmanr(X)
-        return rho
\ No newline at end of file
+        return self.get_correlations(X[np.newaxis])[0]
+
+    def get_correlations(self, X: np.ndarray):
+        return PearsonCorrelationNetwork().get_correlations(rank(X))
+
+# frames whose running sums are updated together, bounding the memory of the cross-products
+ROLLING_BLOCK_SIZE = 256
+# running sums are recomputed from the window after at least this many frames (and window frames), bounding their drift
+ROLLING_RESYNC_FRAMES = 4096
+
+class RollingCorrelationNetwork():
+    """
+    Pearson correlation networks over sliding windows of window frames, every step frames, of a stream of frames
+    (e.g., the mfccs of a live recording) pushed in chunks of any size. The sums and cross-products of the current window 
+    are kept across pushes: each frame adds its own and subtracts those of the frame leaving the window, so a frame 
+    costs O(n_features^2) whatever the window. The last window frames are kept in a ring buffer, from which the sums are 
+    recomputed every ROLLING_RESYNC_FRAMES frames to bound the rounding drift.
+    Frames are shifted by the first one to keep the sums well conditioned.
+    """
+
+    def __init__(self, window, step=1) -> None:
+        self.window = window
+        self.step = step
+        self.reset()
+
+    def reset(self):
+        self.frames_ = None
+        self.shift_ = None
+        self.sum_ = None
+        self.cross_sum_ = None
+        self.n_frames_ = 0
+        self.n_updates_ = 0
+        return self
+
+    def resync(self):
+        """Recomputes the sums and cross-products of the current window from its frames."""
+        # slots not filled yet hold zeros
+        self.sum_ = self.frames_.sum(axis=0)
+        self.cross_sum_ = self.frames_.T @ self.frames_
+        self.n_updates_ = 0
+
+    def update(self, X):
+        """
+        Adds frames X (at most window of them) shaped (n_frames, n_features) to the window, returning the sums 
+        and cross-products of the window ending at each of them.
+        """
+        t = self.n_frames_ + np.arange(len(X))
+        slots = t % self.window
+        # frame t takes the slot of frame t - window, which leaves the window (zeros while t < window)
+        leaving = self.frames_[slots]
+        self.frames_[slots] = X
+        S1 = self.sum_ + np.cumsum(X - leaving, axis=0)
+        S2 = np.einsum("ti,tj->tij", X, X) - np.einsum("ti,tj->tij", leaving, leaving)
+        S2 = np.cumsum(S2, axis=0, out=S2)
+        S2 += self.cross_sum_
+        self.sum_, self.cross_sum_ = S1[-1].copy(), S2[-1].copy()
+        self.n_frames_ += len(X)
+        self.n_updates_ += len(X)
+        if self.n_updates_ >= max(self.window, ROLLING_RESYNC_FRAMES):
+            self.resync()
+        return S1, S2
+
+    def push(self, X):
+        """Appends frames X shaped (n_features, n_frames), returning the features of the windows they complete."""
+        X = np.asarray(X, dtype=np.float64).T
+        if self.shift_ is None:
+            if not len(X):
+                return np.empty((0, X.shape[1] * (X.shape[1] - 1) // 2))
+            self.shift_ = X[0].copy()
+            self.frames_ = np.zeros((self.window, X.shape[1]))
+            self.sum_ = np.zeros(X.shape[1])
+            self.cross_sum_ = np.zeros((X.shape[1], X.shape[1]))
+        X = X - self.shift_
+
+        features = []
+        # frames of a block must not leave the window within the block, hence at most window of them
+        block_size = min(ROLLING_BLOCK_SIZE, self.window)
+        for block in range(0, len(X), block_size):
+            t = self.n_frames_ + np.arange(len(X[block:block + block_size]))
+            S1, S2 = self.update(X[block:block + block_size])
+            # the window ending at frame t starts at t + 1 - window, a multiple of step
+            starts = t + 1 - self.window
+            ends = np.flatnonzero((starts >= 0) & (starts % self.step == 0))
+            m = S1[ends] / self.window
+            cov = S2[ends] / self.window - m[:, :, np.newaxis] * m[:, np.newaxis, :]
+            C, _ = covariance_to_correlation(cov)
+            features.append(get_triu(C))
+        n_edges = X.shape[1] * (X.shape[1] - 1) // 2
+        return np.concatenate(features) if features else np.empty((0, n_edges))
+
+    def get_features(self, X):
+        """Features of the windows of one clip shaped (n_features, n_frames), as a new stream."""
+        self.reset()
+        features = self.push(X)
+        self.reset()
+        return features
@@ -1,5 +1,7 @@
 from .mel import *
 from .stats import *
+from .spectral import SpectralFrontEnd
+from .cache import FeatureCache
 
 ALL = [
     Array2MelSpec,
@@ -0,0 +1,135 @@
+"""On-disk cache of the features of each clip."""
+
+import os
+import hashlib
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.pipeline import Pipeline
+from mtsa.utils import AudioCache, stream_transform
+from mtsa.ragged import RaggedArray, stack_clips
+
+# parameters that change how features are computed (or how clips are decoded), not their values
+IGNORED_PARAMS = ("frontend", "batch_size", "n_jobs", "backend", "max_in_flight", "cache", "chunk_size", "prefetch")
+
+def get_input_key(Xi):
+    """Identity of one input: the path, modification time and size of a file, or the samples of a clip."""
+    if isinstance(Xi, (str, os.PathLike)):
+        stat = os.stat(Xi)
+        return (os.path.abspath(Xi), stat.st_mtime_ns, stat.st_size)
+    Xi = np.ascontiguousarray(Xi)
+    digest = hashlib.blake2b(Xi.view(np.uint8), digest_size=16).hexdigest()
+    return (digest, Xi.shape, Xi.dtype.str)
+
+def get_params_key(value):
+    """Parameters of an estimator (nested estimators included) as a deterministic, hashable value."""
+    if hasattr(value, "get_params"):
+        params = value.get_params(deep=False)
+        return (type(value).__qualname__, tuple(
+            (name, get_params_key(v)) for name, v in sorted(params.items()) if name not in IGNORED_PARAMS
+            ))
+    if isinstance(value, (list, tuple)):
+        return tuple(map(get_params_key, value))
+    if isinstance(value, dict):
+        return tuple((k, get_params_key(v)) for k, v in sorted(value.items()))
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return repr(value)
+
+def take(X, indices):
+    if isinstance(X, (np.ndarray, RaggedArray)):
+        return X[indices]
+    return [X[i] for i in indices]
+
+def get_steps(transformer):
+    return transformer.steps if isinstance(transformer, Pipeline) else [(None, transformer)]
+
+
+class FeatureCache(BaseEstimator, TransformerMixin):
+    """
+     Wraps a transformer of mtsa.features, storing the features of each clip on disk, keyed by the identity
+     of the clip (its path, modification time and size when given files, otherwise its samples) and the parameters 
+     of the transformer. The transformer may be a Pipeline starting with the decoding step (e.g., Wav2Array), 
+     so a clip found in the cache is neither decoded nor hashed.
+     Only clips missing from the cache go through the transformer, batch_size clips at a time (all of them when None),
+     so fitting the same clips again (e.g., a search over the parameters of the final model) reads the features 
+     back memory-mapped. The steps of the transformer are stateless: fit does not transform X.
+     cache is a directory or an AudioCache; entries beyond max_bytes are evicted, least recently used first.
+    """
+
+    def __init__(self, transformer, cache, max_bytes=None, batch_size=None):
+        self.transformer = transformer
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+
+    def get_cache(self):
+        if isinstance(self.cache, AudioCache):
+            return self.cache
+        return AudioCache(self.cache, max_bytes=self.max_bytes)
+
+    def get_keys(self, X):
+        params_key = get_params_key(self.transformer)
+        def get_key(Xi):
+            identity = (get_input_key(Xi), params_key)
+            return hashlib.sha1(repr(identity).encode()).hexdigest()
+        return list(map(get_key, X))
+
+    @property
+    def concatenates(self):
+        """Whether the transformer concatenates the features of all clips (e.g., Array2MelSpec)."""
+        return hasattr(get_steps(self.transformer)[-1][1], "transform_with_offsets")
+
+    def fit(self, X, y=None, **fit_params):
+        if not isinstance(self.transformer, Pipeline):
+            self.transformer.fit(X, y, **fit_params)
+            return self
+        # a pipeline is fitted step by step on X itself, rather than decoding and transforming it 
+        for _, step in self.transformer.steps:
+            step.fit(X)
+        return self
+
+    def transform_clips(self, X):
+        """Features of each clip of X, computed by the transformer."""
+        steps = get_steps(self.transformer)
+        for _, step in steps[:-1]:
+            X = step.transform(X)
+        last = steps[-1][1]
+        if not self.concatenates:
+            return last.transform(X)
+        Xt, offsets = last.transform_with_offsets(X)
+        return [Xt[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def get_features(self, X):
+        """Features of each clip of X, computing the missing ones batch_size clips at a time."""
+        cache = self.get_cache()
+        keys = self.get_keys(X)
+        features = [cache.get(key) for key in keys]
+        missing = [i for i, Fi in enumerate(features) if Fi is None]
+        batch_size = self.batch_size or max(len(missing), 1)
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            for i, Fi in zip(batch, self.transform_clips(take(X, batch))):
+                Fi = np.asarray(Fi)
+                cache.put(keys[i], Fi)
+                features[i] = Fi
+        return features
+
+    @stream_transform
+    def transform(self, X, y=None, **fit_params):
+        if self.concatenates:
+            Xt, _ = self.transform_with_offsets(X)
+            return Xt
+        if len(X) == 0:
+            return self.transform_clips(X)
+        Xt = stack_clips(self.get_features(X), n=len(X))
+        return Xt
+
+    def transform_with_offsets(self, X):
+        """transform_with_offsets of a transformer that concatenates the features of all clips (e.g., Array2MelSpec)."""
+        if len(X) == 0:
+            Xt = self.transform_clips(X)
+            return np.empty((0,) + np.shape(Xt)[1:]), np.zeros(1, dtype=np.int64)
+        features = self.get_features(X)
+        offsets = np.concatenate([[0], np.cumsum([len(Fi) for Fi in features])])
+        Xt = np.concatenate(features)
+        return Xt, offsets
@@ -2,19 +2,129 @@
 
 import numpy as np
 import sys
+import warnings
 from sklearn.base import BaseEstimator, TransformerMixin
 import scipy.stats as st
 import librosa as lib
 from functools import reduce
+from numpy.lib.stride_tricks import as_strided
+from mtsa.utils import (
+    stream_transform, 
+    NATIVE, 
+    SharedArray,
+    effective_n_jobs,
+    get_process_pool,
+)
+from mtsa.ragged import RaggedArray
+from mtsa.features.spectral import (
+    BATCH_SIZE,
+    MFCC_PARAMS,
+    N_MFCC,
+    get_lengths,
+    get_n_frames,
+    get_frames,
+    get_inner_shape,
+    get_plan,
+    iter_melspectrograms,
+    power_to_db,
+)
+
+def check_sampling_rate(sampling_rate):
+    if sampling_rate == NATIVE:
+        raise ValueError(
+            "sampling_rate is NATIVE: set it to the rate recorded by Wav2Array.fit (sampling_rate_), "
+            "e.g., with mtsa.utils.set_native_sampling_rate")
+
+def stack_frames(log_mel_spectrogram, frames, out=None):
+    """
+    Feature vectors concatenating frames consecutive rows of log_mel_spectrogram, shaped (n_frames, n_mels).
+    Consecutive rows of a C-contiguous array are contiguous in memory, so the vectors are a strided view of it, 
+    copied only into out when given.
+    """
+    log_mel_spectrogram = np.ascontiguousarray(log_mel_spectrogram)
+    n_frames, n_mels = log_mel_spectrogram.shape
+    n_vectors = max(n_frames - frames + 1, 0)
+    vectors = as_strided(
+        log_mel_spectrogram, 
+        shape=(n_vectors, n_mels * frames), 
+        strides=log_mel_spectrogram.strides, 
+        writeable=False)
+    if out is None:
+        return vectors
+    out[...] = vectors
+    return out
+
+def get_chunks(n_clips, n_jobs, batch_size):
+    """Bounds of the chunks of clips handed to each worker: as many chunks as workers, of at most batch_size clips."""
+    size = max(1, min(batch_size, -(-n_clips // n_jobs)))
+    return [(start, min(start + size, n_clips)) for start in range(0, n_clips, size)]
+
+def _write_features(transformer, X, out, key):
+    # runs on a worker process, writing into the shared array of the parent
+    try:
+        transformer.write_features(X, out.array[key])
+    finally:
+        out.close()
+
+def transform_parallel(transformer, X, shape, get_key):
+    """
+    Features of the clips of X, written by transformer.write_features into one array shaped shape.
+    With n_jobs, chunks of clips go to a pool of worker processes, each writing the features of clips start:end 
+    into out[get_key(start, end)], out being in shared memory, so no features are pickled back.
+    A transformer with a frontend transforms the clips in this process, where the front-end keeps its spectrograms.
+    Workers import the __main__ module, so a script calling it with n_jobs > 1 must run under 
+    an if __name__ == "__main__": guard (see mtsa.utils.MP_CONTEXT).
+    """
+    n_jobs = effective_n_jobs(transformer.n_jobs)
+    if n_jobs > 1 and transformer.frontend is not None:
+        warnings.warn(
+            f"{type(transformer).__name__} ignores n_jobs={transformer.n_jobs} with a frontend: "
+            "worker processes would get empty copies of the front-end, so its spectrograms would be neither reused nor shared.")
+        n_jobs = 1
+    chunks = get_chunks(len(X), n_jobs, transformer.batch_size)
+    if n_jobs == 1 or len(chunks) <= 1:
+        return transformer.write_features(X, np.empty(shape, dtype=transformer.dtype))
+    out = SharedArray(shape, transformer.dtype)
+    try:
+        pool = get_process_pool(n_jobs)
+        futures = [
+            pool.submit(_write_features, transformer, X[start:end], out, get_key(start, end)) 
+            for start, end in chunks
+            ]
+        for future in futures:
+            future.result()
+        Xt = np.array(out.array)
+    finally:
+        out.close()
+        out.unlink()
+    return Xt
+
+def get_log_mel_spectrogram(mel_spectrogram, power, dtype=np.float32):
+    """Log mel energy of mel_spectrogram shaped (n_mels, n_frames), laid out frame by frame, shaped (n_frames, n_mels)."""
+    log_mel_spectrogram = np.ascontiguousarray(mel_spectrogram.T, dtype=dtype)
+    log_mel_spectrogram += sys.float_info.epsilon
+    np.log10(log_mel_spectrogram, out=log_mel_spectrogram)
+    log_mel_spectrogram *= 20.0 / power
+    return log_mel_spectrogram
 
 class Array2MelSpec(BaseEstimator, TransformerMixin):
+    """
+     Transforms a numpy array of audio signals into the vectors of frames consecutive frames of their log mel spectrograms.
+
+     With n_jobs, chunks of clips are transformed on a pool of worker processes kept alive across calls,
+     unless frontend is given (see transform_parallel), so scripts must run under an if __name__ == "__main__": guard.
+    """
     def __init__(self, 
                  sampling_rate,
                  n_fft,
                  hop_length,
                  n_mels,
                  frames,
-                 power
+                 power,
+                 batch_size=BATCH_SIZE,
+                 frontend=None,
+                 dtype="float32",
+                 n_jobs=None
                  ):
         self.sampling_rate = sampling_rate
         self.n_fft = n_fft
@@ -22,74 +132,268 @@ class Array2MelSpec(BaseEstimator, TransformerMixin):
         self.n_mels = n_mels
         self.frames = frames
         self.power = power
+        self.batch_size = batch_size
+        self.frontend = frontend
+        self.dtype = dtype
+        self.n_jobs = n_jobs
 
     def fit(self, X, y=None, **fit_params):
+        if self.sampling_rate != NATIVE:
+            self.get_plan()
         return self
 
+    def get_plan(self):
+        """Window and mel filterbank, built once and kept as plan_."""
+        return get_plan(
+            self,
+            sr=self.sampling_rate, 
+            n_fft=self.n_fft, 
+            hop_length=self.hop_length, 
+            n_mels=self.n_mels, 
+            power=self.power,
+            dtype=self.dtype,
+            )
+
+    def get_n_vectors(self, lengths):
+        """Number of feature vectors of clips with the given number of samples."""
+        n_frames = get_n_frames(lengths, self.hop_length)
+        return np.maximum(n_frames - self.frames + 1, 0)
+
+    def normalize_melspec(self, mel_spectrogram, out):
+        """Writes the feature vectors of one clip into out, shaped (n_vectors, n_mels * frames)."""
+
+        # 03 convert melspectrogram to log mel energy, laid out frame by frame
+        log_mel_spectrogram = get_log_mel_spectrogram(mel_spectrogram, self.power, out.dtype)
+
+        # 04 skip too short clips
+        if len(out) < 1:
+            return out
+
+        # 05 generate feature vectors by concatenating multi_frames
+        return stack_frames(log_mel_spectrogram, self.frames, out=out)
+
+    @stream_transform
     def transform(self, X, y=None, **fit_params):
-        
-        def normalize_melspec(mel_spectrogram):
-
-            # 03 convert melspectrogram to log mel energy
-            log_mel_spectrogram = 20.0 / self.power * np.log10(mel_spectrogram + sys.float_info.epsilon)
-
-            # 04 calculate total vector size
-            vectorarray_size = len(log_mel_spectrogram[0, :]) - self.frames + 1
-
-            # 05 skip too short clips
-            if vectorarray_size < 1:
-                return np.empty((0, dims), float)
-
-            # 06 generate feature vectors by concatenating multi_frames
-            dims = self.n_mels * self.frames
-            vectorarray = np.zeros((vectorarray_size, dims), float)
-            for t in range(self.frames):
-                vectorarray[:, self.n_mels * t: self.n_mels * (t + 1)] = log_mel_spectrogram[:, t: t + vectorarray_size].T
-
-            return vectorarray
-            
-        def extract_melspec(y):
-            params = {
-                'y':y, 
-                'n_fft': self.n_fft,
-                'hop_length': self.hop_length,
-                "n_mels": self.n_mels,
-                "power": self.power
-            }
-            if self.sampling_rate:
-                params['sr']=self.sampling_rate
-            
-            mel_spectrogram = lib.feature.melspectrogram(**params)
-            
-            normalized_melspec = normalize_melspec(mel_spectrogram)
-
-            return normalized_melspec
-        Xt = np.array(
-            reduce(
-                lambda n1, n2: np.concatenate([n1,n2]), 
-                map(extract_melspec, X))
-        )
+        Xt, _ = self.transform_with_offsets(X)
+        return Xt
+
+    def transform_with_offsets(self, X):
+        """
+        Returns the feature vectors of all clips in one array, along with offsets such that
+        the vectors of clip i are Xt[offsets[i]:offsets[i + 1]].
+        """
+        check_sampling_rate(self.sampling_rate)
+        self.get_plan()
+
+        # the number of vectors of each clip is known from its length, so they are written in place
+        lengths = get_lengths(X)
+        offsets = np.concatenate([[0], np.cumsum(self.get_n_vectors(lengths))])
+        shape = (offsets[-1], self.n_mels * self.frames)
+        Xt = transform_parallel(self, X, shape, lambda start, end: slice(offsets[start], offsets[end]))
+        return Xt, offsets
+
+    def write_features(self, X, Xt):
+        """Writes the feature vectors of the clips of X, one after the other, into Xt."""
+        plan = self.get_plan()
+        lengths = get_lengths(X)
+        offsets = np.concatenate([[0], np.cumsum(self.get_n_vectors(lengths))])
+
+        # clips sharing a length go through the stft and the mel filterbank together
+        for indices, mel_spectrograms in iter_melspectrograms(X, plan, lengths, self.batch_size, self.frontend):
+            for i, mel_spectrogram in zip(indices, mel_spectrograms):
+                self.normalize_melspec(mel_spectrogram, Xt[offsets[i]:offsets[i + 1]])
         return Xt
     
     
+class StreamingMelSpec(BaseEstimator):
+    """
+     Feature vectors of Array2MelSpec computed on a live stream of samples, one chunk of any size at a time.
+     push returns the vectors completed by a chunk; flush ends the stream, returning the vectors of the last frames,
+     which are centered on the end of the stream, and starts a new one. The vectors of a whole stream match 
+     the vectors Array2MelSpec computes from the clip holding all its samples, up to the rounding of the 
+     mel filterbank product, which BLAS sums in an order depending on the number of frames.
+     The samples of the next frames and the last frames - 1 log mel frames are kept between chunks,
+     so each sample goes through the stft once.
+    """
+
+    def __init__(self, 
+                 sampling_rate,
+                 n_fft,
+                 hop_length,
+                 n_mels,
+                 frames,
+                 power,
+                 dtype="float32"
+                 ):
+        self.sampling_rate = sampling_rate
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.n_mels = n_mels
+        self.frames = frames
+        self.power = power
+        self.dtype = dtype
+
+    @classmethod
+    def from_transformer(cls, array2melspec):
+        """StreamingMelSpec computing the same vectors as an Array2MelSpec, e.g. the array2melspec step of a fitted Hitachi."""
+        return cls(
+            sampling_rate=array2melspec.sampling_rate,
+            n_fft=array2melspec.n_fft,
+            hop_length=array2melspec.hop_length,
+            n_mels=array2melspec.n_mels,
+            frames=array2melspec.frames,
+            power=array2melspec.power,
+            dtype=array2melspec.dtype,
+            )
+
+    def get_plan(self):
+        return get_plan(
+            self,
+            sr=self.sampling_rate, 
+            n_fft=self.n_fft, 
+            hop_length=self.hop_length, 
+            n_mels=self.n_mels, 
+            power=self.power,
+            dtype=self.dtype,
+            )
+
+    def reset(self):
+        """Starts a new stream, whose first frame is centered on its first sample like the frames of Array2MelSpec."""
+        check_sampling_rate(self.sampling_rate)
+        self.get_plan()
+        self.samples_ = np.zeros(max(2 * self.n_fft, 1), dtype=self.dtype)
+        self.n_samples_ = self.n_fft // 2
+        self.log_mel_frames_ = np.empty((0, self.n_mels), dtype=self.dtype)
+        return self
+
+    def _append(self, chunk):
+        n = self.n_samples_ + len(chunk)
+        if n > len(self.samples_):
+            samples = np.empty(max(n, 2 * len(self.samples_)), dtype=self.dtype)
+            samples[:self.n_samples_] = self.samples_[:self.n_samples_]
+            self.samples_ = samples
+        self.samples_[self.n_samples_:n] = chunk
+        self.n_samples_ = n
+
+    def _get_vectors(self):
+        n_new = 0
+        if self.n_samples_ >= self.n_fft:
+            n_new = 1 + (self.n_samples_ - self.n_fft) // self.hop_length
+        if n_new:
+            frames = get_frames(self.samples_[:self.n_samples_], self.n_fft, self.hop_length)[:n_new]
+            mel_spectrogram = self.plan_.melspectrogram_frames(frames)
+            log_mel_frames = np.concatenate([
+                self.log_mel_frames_, 
+                get_log_mel_spectrogram(mel_spectrogram, self.power, self.dtype),
+                ])
+            # the samples left are the start of the next frame onwards
+            consumed = n_new * self.hop_length
+            n_left = self.n_samples_ - consumed
+            self.samples_[:n_left] = self.samples_[consumed:self.n_samples_]
+            self.n_samples_ = n_left
+        else:
+            log_mel_frames = self.log_mel_frames_
+        vectors = np.array(stack_frames(log_mel_frames, self.frames))
+        self.log_mel_frames_ = log_mel_frames[len(log_mel_frames) - min(len(log_mel_frames), self.frames - 1):]
+        return vectors
+
+    def push(self, chunk):
+        """Appends a chunk of samples shaped (n_samples,) to the stream, returning the vectors it completes."""
+        if getattr(self, "samples_", None) is None:
+            self.reset()
+        self._append(np.asarray(chunk, dtype=self.dtype))
+        return self._get_vectors()
+
+    def flush(self):
+        """Ends the stream, returning its last vectors."""
+        if getattr(self, "samples_", None) is None:
+            self.reset()
+        self._append(np.zeros(self.n_fft // 2, dtype=self.dtype))
+        vectors = self._get_vectors()
+        self.reset()
+        return vectors
+
 class Array2Mfcc(BaseEstimator, TransformerMixin):
     """
      Gets a numpy array containing audio signals and transforms it into a numpy array containing mfcc signals
      
+     Clips go through the stft of frontend when given, a SpectralFrontEnd possibly shared with an Array2MelSpec.
+     mfccs are computed and returned as dtype.
+     With n_jobs, chunks of clips are transformed on a pool of worker processes kept alive across calls,
+     unless frontend is given (see transform_parallel), so scripts must run under an if __name__ == "__main__": guard.
     """
     
-    def __init__(self, sampling_rate):
+    def __init__(self, 
+                 sampling_rate, 
+                 batch_size=BATCH_SIZE,
+                 n_fft=MFCC_PARAMS["n_fft"],
+                 hop_length=MFCC_PARAMS["hop_length"],
+                 n_mels=MFCC_PARAMS["n_mels"],
+                 frontend=None,
+                 dtype="float32",
+                 n_jobs=None
+                 ):
         self.sampling_rate = sampling_rate
+        self.batch_size = batch_size
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.n_mels = n_mels
+        self.frontend = frontend
+        self.dtype = dtype
+        self.n_jobs = n_jobs
 
     def fit(self, X, y=None, **fit_params):
+        if self.sampling_rate != NATIVE:
+            self.get_plan()
         return self
 
+    def get_plan(self):
+        """Window, mel filterbank and DCT basis, built once and kept as plan_."""
+        return get_plan(
+            self,
+            sr=self.sampling_rate, 
+            n_fft=self.n_fft, 
+            hop_length=self.hop_length, 
+            n_mels=self.n_mels, 
+            power=MFCC_PARAMS["power"],
+            n_mfcc=N_MFCC,
+            dtype=self.dtype,
+            )
+
+    @stream_transform
     def transform(self, X, y=None, **fit_params):
-        def extract_mfcc(y):
-            if self.sampling_rate: 
-                return lib.feature.mfcc(y=y, sr=self.sampling_rate)
-            else: 
-                return lib.feature.mfcc(y=y)
-        Xt = np.array(list(map(extract_mfcc, X)))
-        return Xt
+        check_sampling_rate(self.sampling_rate)
+        plan = self.get_plan()
+
+        lengths = get_lengths(X)
+        n_frames = get_n_frames(lengths, self.hop_length)
+        inner_shape = get_inner_shape(X) + (plan.n_mfcc,)
+        if len(set(n_frames)) <= 1:
+            shape = (len(X),) + inner_shape + (n_frames[0] if len(X) else 0,)
+            Xt = transform_parallel(self, X, shape, lambda start, end: slice(start, end))
+            return Xt
+
+        # clips of different lengths give mfccs with different number of frames, laid one after the other
+        offsets = np.concatenate([[0], np.cumsum(n_frames)])
+        shape = inner_shape + (offsets[-1],)
+        data = transform_parallel(self, X, shape, lambda start, end: (Ellipsis, slice(offsets[start], offsets[end])))
+        return RaggedArray(data, offsets)
 
+    def write_features(self, X, out):
+        """
+        Writes the mfccs of the clips of X into out, either shaped (n_clips, ..., n_mfcc, n_frames), 
+        or shaped (..., n_mfcc, total n_frames) with the mfccs of clips of different lengths one after the other.
+        """
+        plan = self.get_plan()
+        lengths = get_lengths(X)
+        offsets = np.concatenate([[0], np.cumsum(get_n_frames(lengths, self.hop_length))])
+        uniform = out.ndim == len(get_inner_shape(X)) + 3
+        batches = iter_melspectrograms(X, plan, lengths, self.batch_size, self.frontend)
+        for indices, mel_spectrograms in batches:
+            M = plan.mfcc(power_to_db(mel_spectrograms))
+            if uniform:
+                out[indices] = M
+            else:
+                for i, Mi in zip(indices, M):
+                    out[..., offsets[i]:offsets[i + 1]] = Mi
+        return out
@@ -0,0 +1,226 @@
+"""Batched spectral kernels shared by the mel and mfcc transformers."""
+
+import numpy as np
+import librosa as lib
+import scipy.fft
+import hashlib
+import threading
+from collections import OrderedDict
+from numpy.lib.stride_tricks import sliding_window_view
+from mtsa.utils import DEFAULT_SAMPLING_RATE
+from mtsa.ragged import RaggedArray
+
+BATCH_SIZE = 32
+
+# librosa.feature.mfcc defaults
+MFCC_PARAMS = {
+    "n_fft": 2048,
+    "hop_length": 512,
+    "n_mels": 128,
+    "power": 2.0,
+}
+N_MFCC = 20
+
+def get_lengths(X):
+    """Number of samples of each clip."""
+    if isinstance(X, RaggedArray):
+        return X.lengths
+    if isinstance(X, np.ndarray) and X.dtype != object:
+        return np.full(len(X), X.shape[-1])
+    return np.array([np.shape(Xi)[-1] for Xi in X], dtype=np.int64)
+
+def get_inner_shape(X):
+    """Leading axes shared by the clips of X (e.g., channels), () for mono clips."""
+    if isinstance(X, RaggedArray):
+        return X.data.shape[:-1]
+    if isinstance(X, np.ndarray) and X.dtype != object:
+        return X.shape[1:-1]
+    return np.shape(X[0])[:-1] if len(X) else ()
+
+def get_n_frames(lengths, hop_length):
+    """Number of STFT frames of clips with the given number of samples (centered frames)."""
+    return 1 + np.asarray(lengths, dtype=np.int64) // hop_length
+
+def iter_batches(X, lengths=None, batch_size=BATCH_SIZE):
+    """
+    Yields (indices, batch) where batch stacks up to batch_size clips of X sharing one length,
+    shaped (n_clips, ..., n_samples). A clip whose length no other clip shares comes alone, in a batch of one.
+    """
+    if isinstance(X, np.ndarray) and X.dtype != object:
+        # clips of an array already share their length, so batches are views of X
+        for start in range(0, len(X), batch_size):
+            indices = np.arange(start, min(start + batch_size, len(X)))
+            yield indices, X[start:start + batch_size]
+        return
+    lengths = get_lengths(X) if lengths is None else lengths
+    groups = {}
+    for i, n in enumerate(lengths):
+        groups.setdefault(int(n), []).append(i)
+    for group in groups.values():
+        for start in range(0, len(group), batch_size):
+            indices = np.array(group[start:start + batch_size])
+            yield indices, np.stack([X[i] for i in indices])
+
+def get_window(n_fft, dtype="float32"):
+    # built in float64 by librosa, so rounded once to dtype
+    return lib.filters.get_window("hann", n_fft, fftbins=True).astype(dtype)
+
+def get_frames(Y, n_fft, hop_length):
+    """Frames of n_fft samples every hop_length samples of Y shaped (..., n_samples), as a view shaped (..., n_frames, n_fft)."""
+    return sliding_window_view(Y, n_fft, axis=-1)[..., ::hop_length, :]
+
+def stft(Y, n_fft, hop_length, window=None):
+    """Same as librosa.stft (centered, zero-padded hann frames) for a batch of clips Y shaped (..., n_samples)."""
+    window = get_window(n_fft, np.result_type(Y.dtype, np.float32)) if window is None else window
+    padding = [(0, 0)] * (Y.ndim - 1) + [(n_fft // 2, n_fft // 2)]
+    frames = get_frames(np.pad(Y, padding), n_fft, hop_length)
+    return np.swapaxes(scipy.fft.rfft(frames * window, axis=-1), -1, -2)
+
+def power_spectrogram(Y, n_fft, hop_length, power, window=None):
+    return np.abs(stft(Y, n_fft, hop_length, window)) ** power
+
+class SpectralFrontEnd():
+    """
+    Power spectrograms kept in memory, keyed by a hash of the clip samples and the STFT parameters.
+    Transformers sharing one front-end compute the STFT of a clip once, provided they are handed the same samples
+    with the same n_fft, hop_length and power. Hitachi and MFCCMix do not by default: Hitachi decodes channel 0 
+    with n_fft=1024, MFCCMix down-mixes to mono with n_fft=2048. Hitachi(mono=True, n_fft=2048, frontend=frontend) 
+    and MFCCMix(frontend=frontend) share their STFTs.
+    Every spectrogram is kept by default, as for one evaluation run; with max_bytes, the least recently used ones 
+    are dropped beyond it, so max_bytes should hold the spectrograms of a whole pass over the data.
+    """
+
+    def __init__(self, max_bytes=None) -> None:
+        self.max_bytes = max_bytes
+        self._init_cache()
+
+    def _init_cache(self):
+        self._cache = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # a copy sent to another process starts empty
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    def __deepcopy__(self, memo):
+        # sklearn.clone deep-copies parameters; clones keep sharing the front-end
+        return self
+
+    def get_key(self, y, n_fft, hop_length, power):
+        # the window is always hann, so it is set by n_fft
+        digest = hashlib.blake2b(np.ascontiguousarray(y).view(np.uint8), digest_size=16).hexdigest()
+        return (digest, y.shape, y.dtype.str, n_fft, hop_length, power)
+
+    def get(self, key):
+        with self._lock:
+            S = self._cache.get(key)
+            if S is not None:
+                self._cache.move_to_end(key)
+            return S
+
+    def put(self, key, S):
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = S
+            self._size += S.nbytes
+            while self.max_bytes is not None and self._size > self.max_bytes and self._cache:
+                _, S_old = self._cache.popitem(last=False)
+                self._size -= S_old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._size = 0
+
+    def power_spectrogram(self, Y, n_fft, hop_length, power, window=None):
+        """power_spectrogram of a batch of clips, computing only the clips missing from the cache, in one batch."""
+        keys = [self.get_key(y, n_fft, hop_length, power) for y in Y]
+        spectrograms = [self.get(key) for key in keys]
+        missing = [i for i, S in enumerate(spectrograms) if S is None]
+        if missing:
+            S_missing = power_spectrogram(Y[missing], n_fft, hop_length, power, window)
+            for i, S in zip(missing, S_missing):
+                self.put(keys[i], S)
+                spectrograms[i] = S
+        return np.stack(spectrograms)
+
+def power_to_db(S, amin=1e-10, top_db=80.0):
+    """
+    Same as librosa.power_to_db for a batch of spectrograms shaped (n_clips, ..., n_mels, n_frames):
+    the top_db floor is taken per clip (over all its channels) rather than over the whole batch.
+    """
+    log_spec = 10.0 * np.log10(np.maximum(amin, S))
+    if top_db is not None:
+        floor = log_spec.max(axis=tuple(range(1, log_spec.ndim)), keepdims=True) - top_db
+        log_spec = np.maximum(log_spec, floor)
+    return log_spec
+
+class SpectralPlan():
+    """
+    Hann window, mel filterbank and DCT basis of one spectral configuration, built once 
+    (e.g., when a transformer is fitted) and reused for every batch of clips.
+    Clips are transformed in dtype, the precision of the window and the bases.
+    """
+
+    def __init__(self, sr, n_fft, hop_length, n_mels, power=2.0, n_mfcc=N_MFCC, dtype="float32") -> None:
+        self.params = self.get_params(sr, n_fft, hop_length, n_mels, power, n_mfcc, dtype)
+        self.sr = sr or DEFAULT_SAMPLING_RATE
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.n_mels = n_mels
+        self.power = power
+        self.n_mfcc = n_mfcc
+        self.dtype = np.dtype(dtype)
+        self.window = get_window(n_fft, self.dtype)
+        self.mel_basis = lib.filters.mel(sr=self.sr, n_fft=n_fft, n_mels=n_mels, dtype=self.dtype)
+        # row k holds the k-th orthonormal DCT-II basis vector, as used by librosa.feature.mfcc
+        self.dct_basis = scipy.fft.dct(np.eye(n_mels, dtype=self.dtype), type=2, norm="ortho", axis=0)[:n_mfcc]
+
+    @staticmethod
+    def get_params(sr, n_fft, hop_length, n_mels, power=2.0, n_mfcc=N_MFCC, dtype="float32"):
+        return dict(sr=sr, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels, power=power, n_mfcc=n_mfcc, dtype=np.dtype(dtype))
+
+    def power_spectrogram(self, Y, frontend=None):
+        Y = np.asarray(Y, dtype=self.dtype)
+        if frontend is None:
+            return power_spectrogram(Y, self.n_fft, self.hop_length, self.power, self.window)
+        return frontend.power_spectrogram(Y, self.n_fft, self.hop_length, self.power, self.window)
+
+    def melspectrogram(self, Y, frontend=None):
+        """Same as librosa.feature.melspectrogram, for a batch of clips Y shaped (..., n_samples)."""
+        return np.matmul(self.mel_basis, self.power_spectrogram(Y, frontend))
+
+    def melspectrogram_frames(self, frames):
+        """Mel spectrogram of frames shaped (n_frames, n_fft), e.g. taken from a stream, shaped (n_mels, n_frames)."""
+        frames = np.asarray(frames, dtype=self.dtype)
+        S = np.abs(scipy.fft.rfft(frames * self.window, axis=-1)).T ** self.power
+        return np.matmul(self.mel_basis, S)
+
+    def mfcc(self, S_db):
+        """Same as librosa.feature.mfcc for a batch of log-mel spectrograms shaped (..., n_mels, n_frames)."""
+        return np.matmul(self.dct_basis, S_db)
+
+def get_plan(transformer, **params):
+    """
+    The SpectralPlan of a transformer (its plan_ attribute), rebuilt when 
+    its parameters no longer match the plan, e.g., after set_params.
+    """
+    plan = getattr(transformer, "plan_", None)
+    if plan is None or plan.params != SpectralPlan.get_params(**params):
+        plan = SpectralPlan(**params)
+        transformer.plan_ = plan
+    return plan
+
+def iter_melspectrograms(X, plan, lengths=None, batch_size=BATCH_SIZE, frontend=None):
+    """
+    Yields (indices, mel spectrograms) of the clips of X, one batch of equal-length clips at a time,
+    optionally going through the power spectrograms of a SpectralFrontEnd.
+    """
+    for indices, Y in iter_batches(X, lengths, batch_size):
+        yield indices, plan.melspectrogram(Y, frontend)
@@ -4,49 +4,134 @@ import numpy as np
 from sklearn.base import BaseEstimator, TransformerMixin
 from functools import reduce
 import itertools as ite
+from mtsa.ragged import RaggedArray
 
 class MagnitudeMeanFeatureMfcc(BaseEstimator, TransformerMixin):
     
-    def __init__(self) -> None:
+    def __init__(self, dtype="float32") -> None:
         super().__init__()
+        self.dtype = dtype
         
     def fit(self, X, y=None):
         return self
     
     def transform(self, X, y=None, **fit_params):
-        Xt = X.mean(axis=2)
+        if isinstance(X, RaggedArray):
+            Xt = np.add.reduceat(X.data, X.offsets[:-1], axis=-1).T / X.lengths[:, np.newaxis]
+            return Xt.astype(self.dtype, copy=False)
+        Xt = X.mean(axis=2, dtype=self.dtype)
         return Xt
     
 class MagnitudeStdFeatureMfcc(BaseEstimator, TransformerMixin):
     
-    def __init__(self) -> None:
+    def __init__(self, dtype="float32") -> None:
         super().__init__()
+        self.dtype = dtype
         
     def fit(self, X, y=None):
         return self
     
     def transform(self, X, y=None, **fit_params):
-        Xt = X.std(axis=2)
+        if isinstance(X, RaggedArray):
+            return np.array([Xi.std(axis=-1) for Xi in X], dtype=self.dtype)
+        Xt = X.std(axis=2, dtype=self.dtype)
         return Xt
     
-from mtsa.correlation_networks import PearsonCorrelationNetwork
+from mtsa.correlation_networks import (
+    PearsonCorrelationNetwork,
+    covariance_to_correlation,
+    get_covariances,
+    get_triu,
+)
 class CorrelationFeatureMfcc(BaseEstimator, TransformerMixin):
+    """
+     Upper triangle of the correlation network of the mfccs of each clip, Pearson unless network 
+     is given (e.g., a SpearmanCorrelationNetwork).
+    """
     
-    def __init__(self) -> None:
+    def __init__(self, dtype="float32", network=None) -> None:
         super().__init__()
+        self.dtype = dtype
+        self.network = network
     
     def fit(self, X, y=None):
         return self
     
     def transform(self, X, y=None, **fit_params):
-        def get_triu(G):
-            return G[np.triu_indices(len(G), k = 1)]
-        corr = PearsonCorrelationNetwork()
-        Xt = map(corr.get_correlation, X)
-        Xt = map(get_triu, Xt)
-        Xt= np.array(list(Xt)) 
+        corr = self.network or PearsonCorrelationNetwork()
+        if isinstance(X, np.ndarray) and X.dtype != object:
+            # the correlation matrices of all clips come from one batched matmul
+            Xt = corr.get_features(X).astype(self.dtype, copy=False)
+            return Xt
+        Xt = map(lambda Xi: corr.get_features(Xi[np.newaxis])[0], X)
+        Xt= np.array(list(Xt), dtype=self.dtype) 
         return Xt
     
+def get_correlations(network, X):
+    """Correlation matrices of the clips of X, batched when they share one shape."""
+    if isinstance(X, np.ndarray) and X.dtype != object:
+        return network.get_correlations(X)
+    return np.array([network.get_correlations(Xi[np.newaxis])[0] for Xi in X])
+
+class SparseCorrelationFeatureMfcc(BaseEstimator, TransformerMixin):
+    """
+     Correlations of a fixed set of edges of the correlation network of the mfccs of each clip, chosen at fit from
+     the mean absolute correlation of the training clips: the k strongest edges of each node (k), the edges 
+     stronger than threshold, or the given edges, shaped (2, n_edges) as edges_ (so a fitted edges_ can be passed on). 
+     The edges are stored as edges_, rows i < j, so the number of features is the number of edges rather than 
+     n_mfcc * (n_mfcc - 1) / 2.
+    """
+
+    def __init__(self, k=None, threshold=None, edges=None, network=None, dtype="float32") -> None:
+        super().__init__()
+        self.k = k
+        self.threshold = threshold
+        self.edges = edges
+        self.network = network
+        self.dtype = dtype
+
+    def get_edges(self, weights):
+        """Edges (i < j) selected from a matrix of weights shaped (n_mfcc, n_mfcc)."""
+        n = len(weights)
+        if self.edges is not None:
+            edges = np.asarray(self.edges, dtype=np.int64)
+            if edges.ndim != 2 or len(edges) != 2:
+                raise ValueError(f"edges must be shaped (2, n_edges), as edges_, got {edges.shape}")
+            if np.any(edges[0] == edges[1]):
+                raise ValueError("edges must join two different mfccs, a self-loop (i, i) is a constant feature")
+            if np.any((edges < 0) | (edges >= n)):
+                raise ValueError(f"edges must join mfccs 0 to {n - 1}")
+            edges = np.sort(edges.T, axis=1)
+        elif self.k is not None:
+            weights = np.where(np.eye(n, dtype=bool), -np.inf, weights)
+            neighbors = np.argsort(-weights, axis=1, kind="stable")[:, :min(self.k, n - 1)]
+            nodes = np.repeat(np.arange(n), neighbors.shape[1])
+            edges = np.sort(np.stack([nodes, neighbors.ravel()], axis=1), axis=1)
+        elif self.threshold is not None:
+            edges = np.stack(np.triu_indices(n, k=1), axis=1)
+            edges = edges[weights[edges[:, 0], edges[:, 1]] >= self.threshold]
+            if len(edges) == 0:
+                raise ValueError(
+                    f"no edge has a mean absolute correlation of at least threshold={self.threshold} "
+                    f"(the strongest is {weights[np.triu_indices(n, k=1)].max(initial=0):.3f}), so there would be no features")
+        else:
+            raise ValueError("one of k, threshold or edges must be set")
+        # edges come in the order of the upper triangle, as the columns of CorrelationFeatureMfcc
+        edges = np.unique(edges, axis=0).reshape(-1, 2)
+        return edges.T
+
+    def fit(self, X, y=None):
+        network = self.network or PearsonCorrelationNetwork()
+        weights = np.nan_to_num(np.abs(get_correlations(network, X))).mean(axis=0)
+        self.edges_ = self.get_edges(weights)
+        return self
+
+    def transform(self, X, y=None, **fit_params):
+        network = self.network or PearsonCorrelationNetwork()
+        C = get_correlations(network, X)
+        Xt = C[:, self.edges_[0], self.edges_[1]].astype(self.dtype, copy=False)
+        return Xt
+
 
 FEATURES = [
     ("M", MagnitudeMeanFeatureMfcc()), 
@@ -54,6 +139,83 @@ FEATURES = [
     ("C", CorrelationFeatureMfcc())
 ]
 
+STATISTICS = {
+    "M": MagnitudeMeanFeatureMfcc,
+    "S": MagnitudeStdFeatureMfcc,
+    "C": CorrelationFeatureMfcc,
+}
+# clips transformed together, so a block of mfccs stays in cache while its statistics are computed
+STATISTICS_BLOCK_SIZE = 64
+
+class StatisticsFeatureMfcc(BaseEstimator, TransformerMixin):
+    """
+     Fused M, S and C features: the mean, the standard deviation and the upper triangle of the correlation 
+     matrix of the mfccs of each clip, computed from one centered copy of a block of clips
+     (see mtsa.correlation_networks.get_covariances).
+     features is any subset of "MSC"; columns come in the order of features, as in a FeatureUnion of FEATURES.
+    """
+
+    def __init__(self, features="MSC", dtype="float32") -> None:
+        super().__init__()
+        self.features = features
+        self.dtype = dtype
+
+    def fit(self, X, y=None):
+        return self
+
+    def get_n_columns(self, n_mfcc):
+        n_columns = {"M": n_mfcc, "S": n_mfcc, "C": n_mfcc * (n_mfcc - 1) // 2}
+        return [n_columns[f] for f in self.features]
+
+    def get_columns(self, n_mfcc):
+        """Columns of each feature, e.g. {"M": slice(0, 20), "S": slice(20, 40), "C": slice(40, 230)} for 20 mfccs."""
+        offsets = np.concatenate([[0], np.cumsum(self.get_n_columns(n_mfcc))])
+        return {f: slice(int(start), int(end)) for f, start, end in zip(self.features, offsets[:-1], offsets[1:])}
+
+    def get_statistics(self, X):
+        """Statistics of a block of clips shaped (n_clips, n_mfcc, n_frames)."""
+        if "C" in self.features:
+            # the variances are the diagonal of the covariances the correlations come from
+            m, cov = get_covariances(X)
+            corr, std = covariance_to_correlation(cov)
+            return {"M": m, "S": std, "C": get_triu(corr)}
+        m = np.mean(X, axis=-1, dtype=np.float64)
+        if "S" not in self.features:
+            return {"M": m}
+        D = X - m[..., np.newaxis]
+        return {"M": m, "S": np.sqrt(np.mean(D * D, axis=-1))}
+
+    def transform(self, X, y=None, **fit_params):
+        if isinstance(X, RaggedArray):
+            n_mfcc = X.data.shape[0]
+            blocks = ((i, Xi[np.newaxis]) for i, Xi in enumerate(X))
+        else:
+            n_mfcc = X.shape[1]
+            blocks = ((start, X[start:start + STATISTICS_BLOCK_SIZE]) for start in range(0, len(X), STATISTICS_BLOCK_SIZE))
+        columns = self.get_columns(n_mfcc)
+        Xt = np.empty((len(X), sum(self.get_n_columns(n_mfcc))), dtype=self.dtype)
+        for start, block in blocks:
+            statistics = self.get_statistics(block)
+            for f in self.features:
+                Xt[start:start + len(block), columns[f]] = statistics[f]
+        return Xt
+
+def fuse_features(features, dtype="float32"):
+    """
+    StatisticsFeatureMfcc computing the same columns as a FeatureUnion of features, 
+    or None when features are not all taken from FEATURES.
+    """
+    def is_fusable(name, transformer):
+        if type(transformer) is not STATISTICS.get(name):
+            return False
+        # the correlations of StatisticsFeatureMfcc are Pearson
+        network = getattr(transformer, "network", None)
+        return network is None or type(network) is PearsonCorrelationNetwork
+    fusable = all(is_fusable(name, transformer) for name, transformer in features)
+    if not features or not fusable:
+        return None
+    return StatisticsFeatureMfcc(features="".join(name for name, _ in features), dtype=dtype)
+
 def get_features(self):
     number_features = np.arange(1, len(FEATURES)+1)
     def combinations(r): return ite.combinations(FEATURES, r)
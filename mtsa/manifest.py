@@ -0,0 +1,120 @@
+"""Dataset manifest: one scan of a dataset root, reused by the files_train_test_split family."""
+
+import os
+import re
+import fnmatch
+import numpy as np
+import soundfile as sf
+from mtsa.utils import (
+    NORMAL,
+    ABNORMAL,
+    ordered_map,
+)
+
+UNKNOWN = -1
+
+COLUMNS = [
+    ("path", str),
+    ("directory", str),
+    ("label", np.int8),
+    ("machine_type", str),
+    ("machine_id", str),
+    ("duration", np.float32),
+    ("channels", np.int16),
+    ("sampling_rate", np.int32),
+]
+
+def parse_path(path):
+    """
+    Label, machine type and machine ID of a clip, for the MIMII layout
+    (machine_type/id_00/normal/00000000.wav) and the DCASE 2020 task 2 layout (machine_type/train/normal_id_00_00000000.wav).
+    """
+    parts = os.path.normpath(path).split(os.sep)
+    name = parts[-1]
+    parents = [""] * 3 + parts[:-1]
+    if parents[-1] in ("normal", "abnormal"):
+        label = NORMAL if parents[-1] == "normal" else ABNORMAL
+        return label, parents[-3], parents[-2]
+    match = re.match(r"(normal|anomaly)_(id_\d+)", name)
+    if match:
+        label = NORMAL if match.group(1) == "normal" else ABNORMAL
+        return label, parents[-2], match.group(2)
+    return UNKNOWN, "", ""
+
+def read_header(path):
+    info = sf.info(path)
+    return info.duration, info.channels, info.samplerate
+
+def build_manifest(root, output=None, n_jobs=-1, pattern="*.wav"):
+    """
+    Walks root once and reads the header of every clip on a pool of n_jobs threads.
+    The manifest is saved to output (a .npy file) when given.
+    """
+    paths = []
+    # clips of a directory keep the order glob.glob lists them in, so splits match those made without a manifest
+    for directory, _, names in sorted(os.walk(os.path.abspath(root))):
+        paths.extend(os.path.join(directory, name) for name in fnmatch.filter(names, pattern))
+    headers = ordered_map(read_header, paths, n_jobs=n_jobs)
+    rows = [
+        (path, os.path.dirname(path)) + parse_path(path) + header
+        for path, header in zip(paths, headers)
+    ]
+    columns = list(zip(*rows)) if rows else [[] for _ in COLUMNS]
+    # strings take the width of the longest one rather than being stored as python objects
+    columns = [np.array(column, dtype=dtype) for column, (_, dtype) in zip(columns, COLUMNS)]
+    table = np.empty(len(rows), dtype=[(name, column.dtype) for (name, _), column in zip(COLUMNS, columns)])
+    for (name, _), column in zip(COLUMNS, columns):
+        table[name] = column
+    manifest = Manifest(table)
+    if output:
+        manifest.save(output)
+    return manifest
+
+
+class Manifest():
+    """
+    Table of the clips of a dataset with their path, label, machine type and ID, duration, channels and sampling rate.
+    Pass it to get_files_from_path and the files_train_test_split family in place of globbing the directories.
+    """
+
+    def __init__(self, table) -> None:
+        self.table = table
+        self._by_directory = None
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path))
+
+    def save(self, path):
+        np.save(path, self.table)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, column):
+        return self.table[column]
+
+    def select(self, **conditions):
+        mask = np.ones(len(self.table), dtype=bool)
+        for column, value in conditions.items():
+            mask &= self.table[column] == value
+        return Manifest(self.table[mask])
+
+    def get_rows(self, directory):
+        if self._by_directory is None:
+            self._by_directory = {}
+            for i, d in enumerate(self.table["directory"]):
+                self._by_directory.setdefault(d, []).append(i)
+        directory = os.path.abspath(directory)
+        if directory not in self._by_directory:
+            # rather than an empty split, e.g. for a directory outside the scanned root or created after the scan
+            raise ValueError(f"{directory} holds no clip of the manifest: build the manifest again from a root holding it")
+        return self.table[self._by_directory[directory]]
+
+    def get_files(self, directory, pattern="*.wav"):
+        """Same files, in the same order, as glob.glob(os.path.join(directory, pattern)), without touching the file system."""
+        rows = self.get_rows(directory)
+        names = [os.path.basename(p) for p in rows["path"]]
+        # like glob, hidden files only match patterns starting with a dot
+        names = [n for n in names if fnmatch.fnmatch(n, pattern) and (pattern.startswith(".") or not n.startswith("."))]
+        return [os.path.join(directory, n) for n in names]
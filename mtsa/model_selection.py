@@ -19,10 +19,14 @@ class MFCCMixCV(MFCCMix):
         self,
         sampling_rate = 16000,
         random_state = None,
-        cv=None) -> None:
+        cv=None,
+        feature_cache=None,
+        corpus=None) -> None:
         super(MFCCMixCV, self).__init__(
             random_state=random_state,
-            sampling_rate=sampling_rate
+            sampling_rate=sampling_rate,
+            feature_cache=feature_cache,
+            corpus=corpus
             )
         if not cv:
             cv = ShuffleSplit(
@@ -9,7 +9,8 @@ from mtsa.features.mel import Array2Mfcc
 from mtsa.models.GANF_components.ganfBaseModel import GANFBaseModel
 from mtsa.utils import Wav2Array
 from sklearn.pipeline import Pipeline
-from mtsa.utils import Wav2Array
+from mtsa.utils import NATIVE, Wav2Array, Stream2Array, set_native_sampling_rate
+from mtsa.corpus import Corpus2Array
 
 class GANF(nn.Module, BaseEstimator, OutlierMixin):
 
@@ -21,7 +22,13 @@ class GANF(nn.Module, BaseEstimator, OutlierMixin):
                  learning_rate = None,
                  mono = True,
                  use_array2mfcc = False,
-                 index_CUDA_device = '0'
+                 index_CUDA_device = '0',
+                 n_jobs = None,
+                 cache = None,
+                 chunk_size = None,
+                 prefetch = 0,
+                 frontend = None,
+                 corpus = None
                  ) -> None:
         super().__init__()
         self.sampling_rate = sampling_rate
@@ -32,6 +39,12 @@ class GANF(nn.Module, BaseEstimator, OutlierMixin):
         self.mono = mono
         self.final_model = GANFBaseModel(index_CUDA_device=index_CUDA_device)
         self.use_array2mfcc = use_array2mfcc
+        self.n_jobs = n_jobs
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.frontend = frontend
+        self.corpus = corpus
         self.model = self._build_model()
 
     @property
@@ -45,6 +58,7 @@ class GANF(nn.Module, BaseEstimator, OutlierMixin):
         if learning_rate is None:
             learning_rate = self.learning_rate
 
+        set_native_sampling_rate(self.model, X)
         return self.model.fit(X, y, 
                               final_model__batch_size=batch_size,
                               final_model__epochs=epochs,
@@ -83,14 +97,27 @@ class GANF(nn.Module, BaseEstimator, OutlierMixin):
         return self.final_model.get_adjacent_matrix()
 
     def _build_model(self):
-        array2mfcc = Array2Mfcc(sampling_rate=self.sampling_rate)
-        wav2array = Wav2Array(sampling_rate=self.sampling_rate, mono=self.mono)
+        # clips read from a corpus keep the rate they were packed at
+        sampling_rate = self.sampling_rate if self.corpus is None else self.sampling_rate or NATIVE
+        array2mfcc = Array2Mfcc(sampling_rate=sampling_rate, frontend=self.frontend, n_jobs=self.n_jobs)
+        wav2array = Wav2Array(
+            sampling_rate=sampling_rate, 
+            mono=self.mono, 
+            n_jobs=self.n_jobs, 
+            cache=self.cache, 
+            chunk_size=self.chunk_size, 
+            prefetch=self.prefetch,
+            )
+        if self.corpus is not None:
+            wav2array = Corpus2Array(self.corpus, sampling_rate=sampling_rate, chunk_size=self.chunk_size)
+        stream2array = Stream2Array()
         #mono = (self.mono and not self.use_array2mfcc)
         if self.use_array2mfcc and self.isForWaveData:
             model = Pipeline(
                 steps=[
                     ("wav2array", wav2array),
                     ("array2mfcc", array2mfcc),
+                    ("stream2array", stream2array),
                     ("final_model", self.final_model),
                     ]
                 )
@@ -98,6 +125,7 @@ class GANF(nn.Module, BaseEstimator, OutlierMixin):
             model = Pipeline(
                 steps=[
                     ("wav2array", wav2array),
+                    ("stream2array", stream2array),
                     ("final_model", self.final_model),
                     ]
                 )
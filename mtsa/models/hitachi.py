@@ -3,14 +3,24 @@ from keras.models import Model
 from keras.layers import Input, Dense
 from sklearn.base import BaseEstimator, OutlierMixin
 import numpy as np
-from mtsa.utils import Demux2Array, Wav2Array
+from mtsa.utils import NATIVE, Demux2Array, Wav2Array, Stream2Array, set_native_sampling_rate
+from mtsa.corpus import Corpus2Array
 from mtsa.features.mel import Array2MelSpec
+from mtsa.features.cache import FeatureCache
 from sklearn.pipeline import Pipeline
 from functools import reduce
 
+SCORE_CHUNK_SIZE = 64
+
 class AutoEncoderMixin(Model):
     def score_samples(self, X):
         return -1 * np.mean(np.square(X - self.predict(X))) 
+
+    def score_frames(self, X, offsets):
+        """score_samples of each clip, where the vectors of clip i are X[offsets[i]:offsets[i + 1]]."""
+        errors = np.mean(np.square(X - self.predict(X, verbose=0)), axis=1)
+        cumulative_errors = np.concatenate([[0], np.cumsum(errors, dtype=np.float64)])
+        return -1 * (cumulative_errors[offsets[1:]] - cumulative_errors[offsets[:-1]]) / np.diff(offsets)
     
     def fit(self, x=None, y=None, batch_size=None, epochs=50, verbose=0, callbacks=None, validation_split=0, validation_data=None, shuffle=True, class_weight=None, sample_weight=None, initial_epoch=0, steps_per_epoch=None, validation_steps=None, validation_batch_size=None, validation_freq=1, max_queue_size=10, workers=1, use_multiprocessing=True):
         #TODO final_model__epochs
@@ -23,6 +33,9 @@ class Hitachi(BaseEstimator, OutlierMixin):
       :References:
     Purohit, Harsh, et al. "MIMII Dataset: Sound dataset for malfunctioning industrial machine investigation and inspection." arXiv preprint arXiv:1909.09347 (2019).
     
+      With n_jobs, the mel spectrograms are computed on worker processes, so scripts must run under an 
+      if __name__ == "__main__": guard (see mtsa.utils.MP_CONTEXT).
+    
     """
 
     def __init__(self, 
@@ -38,7 +51,17 @@ class Hitachi(BaseEstimator, OutlierMixin):
                  batch_size=512,
                  shuffle=True,
                  validation_split=0.1,
-                 verbose=0
+                 verbose=0,
+                 n_jobs=None,
+                 cache=None,
+                 chunk_size=None,
+                 channel=0,
+                 res_type=None,
+                 prefetch=0,
+                 frontend=None,
+                 dtype="float32",
+                 feature_cache=None,
+                 corpus=None
                  ) -> None:
         self.sampling_rate = sampling_rate
         self.random_state = random_state
@@ -53,6 +76,16 @@ class Hitachi(BaseEstimator, OutlierMixin):
         self.shuffle=shuffle
         self.validation_split=validation_split
         self.verbose=verbose
+        self.n_jobs=n_jobs
+        self.cache=cache
+        self.chunk_size=chunk_size
+        self.channel=channel
+        self.res_type=res_type
+        self.prefetch=prefetch
+        self.frontend=frontend
+        self.dtype=dtype
+        self.feature_cache=feature_cache
+        self.corpus=corpus
         self.model = self._build_model()
     
 
@@ -61,6 +94,7 @@ class Hitachi(BaseEstimator, OutlierMixin):
         return "Hitachi"
 
     def fit(self, X, y=None):
+        set_native_sampling_rate(self.model, X)
         return self.model.fit(X, 
                               y,
                               final_model__batch_size=self.batch_size,
@@ -105,13 +139,20 @@ class Hitachi(BaseEstimator, OutlierMixin):
         return self.model.predict(X, verbose=0)
 
     def score_samples(self, X):
-        return np.array(
-            list(
-                map(
-                    self.model.score_samples, 
-                    [[x] for x in X])
-                )
-            )
+        # clips are scored a chunk at a time, mapping the vectors of a chunk back to its clips with their offsets
+        chunk_size = self.chunk_size or SCORE_CHUNK_SIZE
+        stream2array = Stream2Array()
+        scores = np.empty(len(X))
+        for start in range(0, len(X), chunk_size):
+            if self.feature_cache is not None:
+                Xt, offsets = self.model["array2melspec"].transform_with_offsets(X[start:start + chunk_size])
+                scores[start:start + len(offsets) - 1] = self.model["final_model"].score_frames(Xt, offsets)
+                continue
+            Xt = self.model["wav2array"].transform(X[start:start + chunk_size])
+            Xt = stream2array.transform(self.model["demux2array"].transform(Xt))
+            Xt, offsets = self.model["array2melspec"].transform_with_offsets(Xt)
+            scores[start:start + len(offsets) - 1] = self.model["final_model"].score_frames(Xt, offsets)
+        return scores
   
     
     def get_model(self):
@@ -128,31 +169,52 @@ class Hitachi(BaseEstimator, OutlierMixin):
         return final_model
     
     def _build_model(self):
+        # clips read from a corpus keep the rate they were packed at
+        sampling_rate = self.sampling_rate if self.corpus is None else self.sampling_rate or NATIVE
+        # a feature cache decodes the clips missing from it chunk_size at a time, rather than as a stream
+        chunk_size = self.chunk_size if self.feature_cache is None else None
+        # only the channel kept by demux2array is decoded
         wav2array = Wav2Array(
-            sampling_rate=self.sampling_rate,
+            sampling_rate=sampling_rate,
             mono=self.mono,
+            channels=None if self.mono else self.channel,
+            n_jobs=self.n_jobs,
+            cache=self.cache,
+            chunk_size=chunk_size,
+            res_type=self.res_type,
+            prefetch=self.prefetch if self.feature_cache is None else 0,
+            dtype=self.dtype,
             )
+        if self.corpus is not None:
+            wav2array = Corpus2Array(self.corpus, sampling_rate=sampling_rate, chunk_size=chunk_size, dtype=self.dtype)
         
-        demux2array = Demux2Array()
+        demux2array = Demux2Array(channel=self.channel)
         array2melspec= Array2MelSpec(
-            sampling_rate=self.sampling_rate,
+            sampling_rate=sampling_rate,
             n_fft=self.n_fft,
             hop_length=self.hop_length,
             n_mels=self.n_mels,
             frames=self.frames,
             power=self.power,
+            frontend=self.frontend,
+            dtype=self.dtype,
+            n_jobs=self.n_jobs,
             )
-        
         final_model = self.get_model()
         
-        model = Pipeline(
-            steps=[
-                ("wav2array", wav2array),
-                ("demux2array", demux2array),
-                ("array2melspec", array2melspec),
-                ("final_model", final_model),
-                ]
-            )
+        steps = [
+            ("wav2array", wav2array),
+            ("demux2array", demux2array),
+            ("array2melspec", array2melspec),
+            ]
+        if self.feature_cache is not None:
+            # the cache is keyed on the files, so the clips found in it are not even decoded
+            steps = [("array2melspec", FeatureCache(Pipeline(steps), cache=self.feature_cache, batch_size=self.chunk_size))]
+        if self.chunk_size:
+            steps.append(("stream2array", Stream2Array()))
+        steps.append(("final_model", final_model))
+
+        model = Pipeline(steps=steps)
         
         return model
 
@@ -1,5 +1,5 @@
 import numpy as np
-from sklearn.base import BaseEstimator, OutlierMixin
+from sklearn.base import BaseEstimator, OutlierMixin, clone
 from sklearn.pipeline import (
     Pipeline, 
     FeatureUnion
@@ -9,36 +9,80 @@ from mtsa.features.stats import (
     MagnitudeStdFeatureMfcc, 
     CorrelationFeatureMfcc,
     FEATURES,
+    fuse_features,
     get_features
     )
 
 from mtsa.features.mel import (
     Array2Mfcc 
 )
+from mtsa.features.spectral import MFCC_PARAMS, N_MFCC
+from mtsa.features.cache import FeatureCache, get_input_key
+from mtsa.corpus import Corpus2Array
 from mtsa.utils import (
+    NATIVE,
     Wav2Array,
+    Stream2Array,
+    Chunkwise,
+    set_native_sampling_rate,
 )
 
 from sklearn.mixture import GaussianMixture
 from functools import reduce
+import itertools as ite
 
 
 
 FINAL_MODEL = GaussianMixture()
+# GaussianMixture fits in the precision of its input, and the covariances of a few clips
+# are too close to singular for float32, so the (small) feature matrix stays float64
+FEATURES_DTYPE = "float64"
+SCORE_BATCH_SIZE = 256
 
 class MFCCMix(BaseEstimator, OutlierMixin):
+    """
+     final_model (a GaussianMixture) fitted on the statistics of FEATURES of the mfccs of each clip.
+     With n_jobs, the mfccs are computed on worker processes, so scripts must run under an 
+     if __name__ == "__main__": guard (see mtsa.utils.MP_CONTEXT).
+    """
 
     def __init__(self, 
                  final_model=FINAL_MODEL, 
                  features=FEATURES,
                  sampling_rate=None,
                  random_state = None,
+                 n_jobs = None,
+                 cache = None,
+                 chunk_size = None,
+                 res_type = None,
+                 prefetch = 0,
+                 frontend = None,
+                 dtype = "float32",
+                 feature_cache = None,
+                 batch_size = None,
+                 corpus = None,
+                 n_fft = MFCC_PARAMS["n_fft"],
+                 hop_length = MFCC_PARAMS["hop_length"],
+                 n_mels = MFCC_PARAMS["n_mels"],
                  ) -> None:
         super().__init__()
         self.sampling_rate = sampling_rate
         self.final_model = final_model
         self.random_state = random_state
         self.features = features
+        self.n_jobs = n_jobs
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.res_type = res_type
+        self.prefetch = prefetch
+        self.frontend = frontend
+        self.dtype = dtype
+        self.feature_cache = feature_cache
+        self.batch_size = batch_size
+        self.corpus = corpus
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.n_mels = n_mels
         self.model = self._build_model()
 
     @property
@@ -46,6 +90,7 @@ class MFCCMix(BaseEstimator, OutlierMixin):
         return "MFCCMix " + "+".join([f[0] for f in self.features])
         
     def fit(self, X, y=None):
+        set_native_sampling_rate(self.model, X)
         return self.model.fit(X, y)
 
     def transform(self, X, y=None):
@@ -59,21 +104,242 @@ class MFCCMix(BaseEstimator, OutlierMixin):
         return self.model.predict(X)
 
     def score_samples(self, X):
-        return self.model.score_samples(X=X)
+        # clips are scored batch_size at a time, so only the clips and mfccs of one batch are held in memory
+        batch_size = self.batch_size or SCORE_BATCH_SIZE
+        scores = np.empty(len(X))
+        for start in range(0, len(X), batch_size):
+            Xt = self.transform(X[start:start + batch_size])
+            scores[start:start + len(Xt)] = self.model["final_model"].score_samples(Xt)
+        return scores
 
-    def _build_model(self):
-        wav2array = Wav2Array(sampling_rate=self.sampling_rate)
-        array2mfcc = Array2Mfcc(sampling_rate=self.sampling_rate)
-        features = FeatureUnion(self.features)
-        
-        model = Pipeline(
-            steps=[
-                ("wav2array", wav2array),
-                ("array2mfcc", array2mfcc),
-                ("features", features),
-                ("final_model", self.final_model),
-                ]
+    def _set_dtype(self, feature):
+        # the features are shared module-level instances, so the copy gets the dtype
+        name, transformer = feature
+        if "dtype" in transformer.get_params():
+            transformer = clone(transformer).set_params(dtype=FEATURES_DTYPE)
+        return name, transformer
+
+    def _build_feature_steps(self):
+        # clips read from a corpus keep the rate they were packed at
+        sampling_rate = self.sampling_rate if self.corpus is None else self.sampling_rate or NATIVE
+        # a feature cache decodes the clips missing from it chunk_size at a time, rather than as a stream
+        chunk_size = self.chunk_size if self.feature_cache is None else None
+        wav2array = Wav2Array(
+            sampling_rate=sampling_rate, 
+            n_jobs=self.n_jobs, 
+            cache=self.cache,
+            chunk_size=chunk_size,
+            res_type=self.res_type,
+            prefetch=self.prefetch if self.feature_cache is None else 0,
+            dtype=self.dtype,
+            )
+        if self.corpus is not None:
+            wav2array = Corpus2Array(self.corpus, sampling_rate=sampling_rate, chunk_size=chunk_size, dtype=self.dtype)
+        array2mfcc = Array2Mfcc(
+            sampling_rate=sampling_rate, 
+            n_fft=self.n_fft,
+            hop_length=self.hop_length,
+            n_mels=self.n_mels,
+            frontend=self.frontend, 
+            dtype=self.dtype, 
+            n_jobs=self.n_jobs,
             )
+        steps = [
+            ("wav2array", wav2array),
+            ("array2mfcc", array2mfcc),
+            ]
+        if self.feature_cache is not None:
+            # the cache is keyed on the files, so the clips found in it are not even decoded
+            steps = [("array2mfcc", FeatureCache(Pipeline(steps), cache=self.feature_cache, batch_size=self.chunk_size))]
+        # the statistics of FEATURES are computed together, in one pass over the mfccs
+        features = fuse_features(self.features, dtype=FEATURES_DTYPE)
+        if features is None:
+            features = FeatureUnion(list(map(self._set_dtype, self.features)))
+        
+        if self.chunk_size:
+            steps.extend([
+                ("features", Chunkwise(features)),
+                ("stream2array", Stream2Array()),
+                ])
+        else:
+            steps.append(("features", features))
+        return steps
+
+    def _build_model(self):
+        steps = self._build_feature_steps()
+        steps.append(("final_model", self.final_model))
+
+        model = Pipeline(steps=steps)
         
         return model
 
+
+def get_subsets(features=FEATURES):
+    """Names of the non-empty subsets of features, in the order of get_features (e.g., M, S, C, MS, MC, SC, MSC)."""
+    names = [name for name, _ in features]
+    subsets = (ite.combinations(names, r) for r in range(1, len(names) + 1))
+    return ["".join(subset) for subset in ite.chain.from_iterable(subsets)]
+
+
+class MFCCMixSubsets(BaseEstimator):
+    """
+     MFCCMix of every subset of FEATURES at once, for feature ablations. The M+S+C features of a dataset are 
+     computed once, by the feature steps of an MFCCMix, and the final model of each subset is fitted on its columns.
+     score_samples and predict return the results of each subset by subset, so it is not an outlier detector itself:
+     get_model returns the MFCCMix of one subset, sharing these features.
+    """
+
+    def __init__(self, 
+                 final_model=FINAL_MODEL, 
+                 subsets=None,
+                 sampling_rate=None,
+                 random_state = None,
+                 n_jobs = None,
+                 cache = None,
+                 chunk_size = None,
+                 res_type = None,
+                 prefetch = 0,
+                 frontend = None,
+                 dtype = "float32",
+                 feature_cache = None,
+                 batch_size = None,
+                 corpus = None,
+                 n_fft = MFCC_PARAMS["n_fft"],
+                 hop_length = MFCC_PARAMS["hop_length"],
+                 n_mels = MFCC_PARAMS["n_mels"],
+                 ) -> None:
+        super().__init__()
+        self.final_model = final_model
+        self.subsets = subsets
+        self.sampling_rate = sampling_rate
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.res_type = res_type
+        self.prefetch = prefetch
+        self.frontend = frontend
+        self.dtype = dtype
+        self.feature_cache = feature_cache
+        self.batch_size = batch_size
+        self.corpus = corpus
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.n_mels = n_mels
+        self.features = FEATURES
+        self.model = self._build_model()
+        self._memo = None
+
+    @property
+    def name(self):
+        return "MFCCMix subsets"
+
+    def __getstate__(self):
+        # the features of the last X scored are not pickled with the model
+        state = self.__dict__.copy()
+        state["_memo"] = None
+        return state
+
+    def get_subsets(self):
+        return self.subsets or get_subsets(self.features)
+
+    def get_n_mfcc(self, n_columns):
+        """Number of mfccs whose M+S+C features take n_columns columns."""
+        features = fuse_features(self.features)
+        return next(n for n in range(1, n_columns + 1) if sum(features.get_n_columns(n)) == n_columns)
+
+    def get_columns(self, subset):
+        """Columns of the M+S+C features holding the features of subset, in the order of a FeatureUnion of subset."""
+        columns = fuse_features(self.features).get_columns(self.n_mfcc_)
+        return np.concatenate([np.arange(columns[f].start, columns[f].stop) for f in subset])
+
+    def transform(self, X, y=None):
+        # the features of the last X are kept, so the models of all subsets score it from one transform
+        key = tuple(map(get_input_key, X))
+        if self._memo is None or self._memo[0] != key:
+            self._memo = (key, self.get_features(X))
+        return self._memo[1]
+
+    def get_features(self, X):
+        """
+        M+S+C features of the clips of X, computed batch_size clips at a time into one array,
+        so only the clips and mfccs of one batch are held in memory.
+        """
+        transform = lambda X: reduce(lambda x, y: y[1].transform(x), self.model.steps, X)
+        batch_size = self.batch_size or SCORE_BATCH_SIZE
+        if len(X) <= batch_size:
+            return transform(X)
+        Xt = None
+        for start in range(0, len(X), batch_size):
+            Xt_batch = transform(X[start:start + batch_size])
+            if Xt is None:
+                Xt = np.empty((len(X),) + Xt_batch.shape[1:], dtype=Xt_batch.dtype)
+            Xt[start:start + len(Xt_batch)] = Xt_batch
+        return Xt
+
+    def fit(self, X, y=None):
+        set_native_sampling_rate(self.model, X)
+        # the features of X are only kept while the final models are fitted
+        Xt = self.model.fit_transform(X, y)
+        self._memo = None
+        self.n_mfcc_ = self.get_n_mfcc(Xt.shape[1])
+        self.final_models_ = {
+            subset: clone(self.final_model).fit(Xt[:, self.get_columns(subset)], y) 
+            for subset in self.get_subsets()
+            }
+        return self
+
+    def score_samples(self, X):
+        """score_samples of the model of each subset, by subset."""
+        Xt = self.transform(X)
+        return {subset: model.score_samples(Xt[:, self.get_columns(subset)]) for subset, model in self.final_models_.items()}
+
+    def predict(self, X):
+        """predict of the model of each subset, by subset."""
+        Xt = self.transform(X)
+        return {subset: model.predict(Xt[:, self.get_columns(subset)]) for subset, model in self.final_models_.items()}
+
+    def get_model(self, subset):
+        return MFCCMixSubset(self, subset)
+
+    def get_models(self):
+        """(name, model) of each subset, named as MFCCMix.name."""
+        return [(model.name, model) for model in map(self.get_model, self.get_subsets())]
+
+    def _build_model(self):
+        # the feature steps of an MFCCMix of FEATURES, fused into one StatisticsFeatureMfcc, with no final model
+        params = {name: value for name, value in self.get_params(deep=False).items() if name != "subsets"}
+        mfccmix = MFCCMix(features=self.features, **params)
+        return Pipeline(steps=mfccmix._build_feature_steps())
+
+
+class MFCCMixSubset(BaseEstimator, OutlierMixin):
+    """
+     MFCCMix of one subset of features, sharing the features of an MFCCMixSubsets.
+    """
+
+    def __init__(self, subsets, subset) -> None:
+        self.subsets = subsets
+        self.subset = subset
+
+    @property
+    def name(self):
+        return "MFCCMix " + "+".join(self.subset)
+
+    @property
+    def final_model(self):
+        return self.subsets.final_models_[self.subset]
+
+    def fit(self, X, y=None):
+        self.subsets.fit(X, y)
+        return self
+
+    def transform(self, X, y=None):
+        return self.subsets.transform(X)[:, self.subsets.get_columns(self.subset)]
+
+    def predict(self, X):
+        return self.final_model.predict(self.transform(X))
+
+    def score_samples(self, X):
+        return self.final_model.score_samples(self.transform(X))
+
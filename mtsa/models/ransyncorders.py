@@ -1,6 +1,8 @@
 import numpy as np
 from mtsa.features.mel import Array2Mfcc
-from mtsa.utils import Wav2Array
+from mtsa.features.spectral import SpectralFrontEnd
+from mtsa.utils import NATIVE, Wav2Array, Stream2Array, set_native_sampling_rate
+from mtsa.corpus import Corpus2Array
 from typing import List, Optional
 from sklearn.pipeline import Pipeline
 from sklearn.base import BaseEstimator, OutlierMixin
@@ -30,6 +32,12 @@ class RANSynCoders(BaseEstimator, OutlierMixin):
                  is_acoustic_data: bool = False,
                  normal_classifier: int = 0,
                  abnormal_classifier: int = 1,
+                 n_jobs: Optional[int] = None,
+                 cache: Optional[str] = None,
+                 chunk_size: Optional[int] = None,
+                 prefetch: int = 0,
+                 frontend: Optional[SpectralFrontEnd] = None,
+                 corpus: Optional[str] = None,
                 ) -> None:
             super().__init__()
             # Rancoders inputs:
@@ -56,6 +64,12 @@ class RANSynCoders(BaseEstimator, OutlierMixin):
             self.is_acoustic_data = is_acoustic_data
             self.normal_classifier = normal_classifier
             self.abnormal_classifier = abnormal_classifier
+            self.n_jobs = n_jobs
+            self.cache = cache
+            self.chunk_size = chunk_size
+            self.prefetch = prefetch
+            self.frontend = frontend
+            self.corpus = corpus
             self.model = self.build_model()
 
     @property
@@ -74,6 +88,10 @@ class RANSynCoders(BaseEstimator, OutlierMixin):
             pos_amp: bool = True,  # whether to constraint amplitudes to be +ve only
             shuffle: bool = True
         ):
+        if "wav2array" in self.model.named_steps and self.model["wav2array"].sampling_rate == NATIVE:
+            set_native_sampling_rate(self.model, X)
+            # the final model has no set_params, so it is handed the rate of the clips directly
+            self.final_model.sampling_rate = self.model["wav2array"].sampling_rate_
         return self.model.fit(X, 
                               y, 
                               final_model__timestamps_matrix = timestamps_matrix,
@@ -141,14 +159,24 @@ class RANSynCoders(BaseEstimator, OutlierMixin):
         return model
     
     def __get_pipeline_steps(self):
-        wav2array = Wav2Array(sampling_rate=self.sampling_rate, mono=self.mono)
-        array2mfcc = Array2Mfcc(sampling_rate=self.sampling_rate)
+        # clips read from a corpus keep the rate they were packed at
+        sampling_rate = self.sampling_rate if self.corpus is None else self.sampling_rate or NATIVE
+        wav2array = Wav2Array(sampling_rate=sampling_rate, 
+                              mono=self.mono, 
+                              n_jobs=self.n_jobs, 
+                              cache=self.cache, 
+                              chunk_size=self.chunk_size, 
+                              prefetch=self.prefetch)
+        if self.corpus is not None:
+            wav2array = Corpus2Array(self.corpus, sampling_rate=sampling_rate, chunk_size=self.chunk_size)
+        array2mfcc = Array2Mfcc(sampling_rate=sampling_rate, frontend=self.frontend, n_jobs=self.n_jobs)
        
         self.final_model = self.get_final_model()
         
         if self.is_acoustic_data:
             steps = [("wav2array", wav2array),
                      ("array2mfcc", array2mfcc),
+                     ("stream2array", Stream2Array()),
                      ("final_model", self.final_model)
                     ]
         else:
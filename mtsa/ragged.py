@@ -0,0 +1,123 @@
+"""Batches of clips of different lengths."""
+
+import numpy as np
+from itertools import chain
+
+
+class RaggedArray():
+    """
+    Batch of clips of different lengths stored in one flat buffer. The clips are laid one after
+    the other along the last axis of data, so clip i is the view data[..., offsets[i]:offsets[i + 1]].
+    Leading axes (e.g., channels or mfccs) are shared by all clips.
+    """
+
+    def __init__(self, data, offsets) -> None:
+        self.data = data
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_arrays(cls, arrays, dtype=None):
+        arrays = list(arrays)
+        if not arrays:
+            return cls(np.empty(0, dtype=dtype or np.float32), [0])
+        inner_shape = arrays[0].shape[:-1]
+        if any(a.shape[:-1] != inner_shape for a in arrays):
+            raise ValueError("clips of a RaggedArray may only differ in their last axis")
+        lengths = [a.shape[-1] for a in arrays]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        data = np.empty(inner_shape + (offsets[-1],), dtype=dtype or arrays[0].dtype)
+        for a, start, end in zip(arrays, offsets[:-1], offsets[1:]):
+            data[..., start:end] = a
+        return cls(data, offsets)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def ndim(self):
+        """Dimensions of the padded batch."""
+        return self.data.ndim + 1
+
+    @property
+    def is_uniform(self):
+        lengths = self.lengths
+        return len(lengths) == 0 or np.all(lengths == lengths[0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            if i < 0:
+                i += len(self)
+            return self.data[..., self.offsets[i]:self.offsets[i + 1]]
+        indices = np.arange(len(self))[i]
+        return RaggedArray.from_arrays([self[j] for j in indices], dtype=self.dtype)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self):
+        return f"RaggedArray(n_clips={len(self)}, inner_shape={self.data.shape[:-1]}, dtype={self.dtype})"
+
+    def to_padded(self, fill_value=0, max_length=None):
+        """
+        Returns the clips padded to a common length, as an array shaped (n_clips, ..., max_length),
+        and a boolean mask shaped (n_clips, max_length) that is True on the samples of each clip.
+        """
+        lengths = self.lengths
+        max_length = max_length or (int(lengths.max()) if len(lengths) else 0)
+        padded = np.full((len(self),) + self.data.shape[:-1] + (max_length,), fill_value, dtype=self.dtype)
+        for i, clip in enumerate(self):
+            padded[i, ..., :clip.shape[-1]] = clip
+        mask = np.arange(max_length) < lengths[:, np.newaxis]
+        return padded, mask
+
+    def to_array(self):
+        """Returns the clips as an array shaped (n_clips, ..., length), which is a view of data when possible."""
+        if not self.is_uniform:
+            raise ValueError("only a RaggedArray whose clips share one length can become an array")
+        if len(self) == 0:
+            return np.empty((0,) + self.data.shape[:-1] + (0,), dtype=self.dtype)
+        length = self.lengths[0]
+        data = self.data[..., self.offsets[0]:self.offsets[-1]]
+        Xt = data.reshape(data.shape[:-1] + (len(self), length))
+        return np.moveaxis(Xt, -2, 0)
+
+
+def stack_clips(arrays, n=None, dtype=None):
+    """
+    Writes clips into one preallocated array as they arrive, so a clip can be released as soon
+    as it is copied. Clips of different lengths are gathered into a RaggedArray instead of an object array.
+    """
+    arrays = iter(arrays)
+    first = next(arrays, None)
+    if first is None:
+        return np.empty(0, dtype=dtype or np.float32)
+    first = np.asarray(first)
+    if n is None:
+        rest = list(arrays)
+        n = len(rest) + 1
+        arrays = iter(rest)
+    Xt = np.empty((n,) + first.shape, dtype=dtype or first.dtype)
+    Xt[0] = first
+    for i, Xi in enumerate(arrays, 1):
+        if np.shape(Xi) != first.shape:
+            return RaggedArray.from_arrays(chain(Xt[:i], [Xi], arrays), dtype=Xt.dtype)
+        Xt[i] = Xi
+    return Xt
+
+
+def concatenate_clips(chunks):
+    """Concatenates batches of clips, keeping a plain array whenever all clips share one shape."""
+    chunks = [c for c in chunks if len(c)]
+    if not chunks:
+        return np.empty(0)
+    if all(isinstance(c, np.ndarray) for c in chunks) and len({c.shape[1:] for c in chunks}) == 1:
+        return np.concatenate(chunks)
+    return RaggedArray.from_arrays(chain.from_iterable(chunks))
@@ -1,32 +1,452 @@
+import numpy as np
 from sklearn.base import BaseEstimator, TransformerMixin
 import librosa as lib
-from functools import reduce
+import soundfile as sf
+import os
+import hashlib
+import threading
+import queue
+from collections import deque
+from collections.abc import Iterator
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+from functools import reduce, partial, wraps
+from mtsa.ragged import RaggedArray, stack_clips, concatenate_clips
 
 NORMAL = 1
 ABNORMAL = 0
+
+# workers are started by a server process rather than forked from this one, as forking a process
+# running threads (e.g., decoding threads, or TensorFlow's) can deadlock the workers
+MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    )
+if MP_CONTEXT.get_start_method() == "forkserver":
+    # the server imports the transformers run on workers once, and each worker is forked from it,
+    # rather than importing mtsa (and with it TensorFlow, keras and torch) again.
+    # Either way, workers import the __main__ module of the parent, so scripts transforming clips with 
+    # n_jobs > 1 must run under an if __name__ == "__main__": guard (otherwise the pool breaks, BrokenProcessPool)
+    MP_CONTEXT.set_forkserver_preload(["mtsa.features.mel"])
+
+EXECUTORS = {
+    "thread": ThreadPoolExecutor,
+    "process": partial(ProcessPoolExecutor, mp_context=MP_CONTEXT),
+}
+
+def effective_n_jobs(n_jobs):
+    if not n_jobs:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+def ordered_map(fun, iterable, n_jobs=None, backend="thread", max_in_flight=None):
+    """
+    Lazily maps fun over iterable on a pool of n_jobs workers, yielding the results in input order.
+    At most max_in_flight (default 2 * n_jobs) results are pending or waiting to be consumed at once.
+    """
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs == 1:
+        yield from map(fun, iterable)
+        return
+    if backend not in EXECUTORS:
+        raise ValueError(f"backend must be one of {sorted(EXECUTORS)}, got {backend!r}")
+    max_in_flight = max_in_flight or 2 * n_jobs
+    with EXECUTORS[backend](max_workers=n_jobs) as executor:
+        pending = deque()
+        for item in iterable:
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fun, item))
+        while pending:
+            yield pending.popleft().result()
+
+# process pools kept alive across calls, by number of workers
+_PROCESS_POOLS = {}
+
+def get_process_pool(n_jobs):
+    """A pool of n_jobs worker processes, started on first use and reused afterwards, so later calls skip the worker startup."""
+    n_jobs = effective_n_jobs(n_jobs)
+    pool = _PROCESS_POOLS.get(n_jobs)
+    if pool is None or getattr(pool, "_broken", False):
+        pool = ProcessPoolExecutor(max_workers=n_jobs, mp_context=MP_CONTEXT)
+        _PROCESS_POOLS[n_jobs] = pool
+    return pool
+
+def shutdown_process_pools():
+    while _PROCESS_POOLS:
+        _, pool = _PROCESS_POOLS.popitem()
+        pool.shutdown()
+
+class SharedArray():
+    """
+    Array in shared memory. It is pickled as the name of its memory block, so a worker process
+    writes into the array of the parent process rather than sending its results back.
+    """
+
+    def __init__(self, shape, dtype, name=None) -> None:
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __reduce__(self):
+        return (SharedArray, (self.shape, self.dtype.str, self.shm.name))
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+def is_stream(X):
+    """A stream is a lazy iterator of chunks of clips, as returned by Wav2Array when chunk_size is set."""
+    return isinstance(X, Iterator)
+
+def iter_chunks(X, chunk_size):
+    X = iter(X)
+    chunk = list(islice(X, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(X, chunk_size))
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def prefetch(iterable, size=1):
+    """
+    Iterates iterable on a background thread, keeping up to size items ready ahead of the consumer,
+    e.g., decoding the next chunks of clips while the features of the current one are computed.
+    """
+    end = object()
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(items, (item, None), stop):
+                    return
+            _put(items, (end, None), stop)
+        except Exception as error:
+            _put(items, (None, error), stop)
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        # lets the producer finish when the consumer stops early
+        stop.set()
+
+def stream_transform(transform):
+    """Makes transform lazily apply itself chunk by chunk when it receives a stream."""
+    @wraps(transform)
+    def transform_stream(self, X, *args, **kwargs):
+        if is_stream(X):
+            return (transform(self, chunk, *args, **kwargs) for chunk in X)
+        return transform(self, X, *args, **kwargs)
+    return transform_stream
+
+DEFAULT_SAMPLING_RATE = 22050
+# decodes clips at the sampling rate they were recorded with, skipping resampling
+NATIVE = "native"
+
+def get_sampling_rate(f, sampling_rate=None):
+    """The sampling rate f is decoded at by load_audio."""
+    if sampling_rate == NATIVE:
+        return sf.info(f).samplerate
+    return sampling_rate or DEFAULT_SAMPLING_RATE
+
+def read_channels(f, channels, blocksize=65536):
+    """
+    Reads only the given channels of f, block by block, so the interleaved array holding every channel is never materialized.
+    An int selects one channel and gives a 1-d array; a list of channels gives an array shaped (len(channels), n_samples).
+    """
+    with sf.SoundFile(f) as fh:
+        s = np.empty((fh.frames,) + np.shape(channels), dtype=np.float32)
+        n = 0
+        for block in fh.blocks(blocksize=blocksize, dtype="float32", always_2d=True):
+            s[n:n + len(block)] = block[:, channels]
+            n += len(block)
+        return s[:n].T, fh.samplerate
+
+def load_audio(f, sampling_rate=None, mono=True, channels=None, res_type=None):
+    # without res_type, librosa resamples with its own default
+    resample_params = {} if res_type is None else {"res_type": res_type}
+    if channels is None:
+        if sampling_rate == NATIVE:
+            s, _ = lib.load(f, sr=None, mono=mono)
+        elif sampling_rate:
+            s, _ = lib.load(f, sr=sampling_rate, mono=mono, **resample_params)
+        else:
+            s, _ = lib.load(f, mono=mono, **resample_params)
+        return s
+    # the channels are selected before resampling, the costly part of decoding
+    s, sr = read_channels(f, channels)
+    if mono and s.ndim > 1:
+        s = lib.to_mono(s)
+    if sampling_rate == NATIVE:
+        return s
+    target_sr = sampling_rate or DEFAULT_SAMPLING_RATE
+    if sr != target_sr:
+        s = lib.resample(s, orig_sr=sr, target_sr=target_sr, **resample_params)
+    return s
+
+class AudioCache():
+    """
+    On-disk cache of decoded clips. Each clip is stored as a .npy file keyed by the file path, 
+    its modification time and size, and the decoding parameters, and is read back memory-mapped.
+    When max_bytes is set, the least recently used entries are evicted once the cache outgrows it.
+    """
+
+    SUFFIX = ".npy"
+
+    def __init__(self, directory, max_bytes=None, mmap_mode="r") -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        self._init_size()
+        os.makedirs(directory, exist_ok=True)
+
+    def _init_size(self):
+        # size of the entries, shared by the decoding threads, counted from the directory on first put
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # a copy sent to another process counts the size of the entries again
+        state = self.__dict__.copy()
+        del state["_size"], state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_size()
+
+    def get_key(self, f, **params):
+        stat = os.stat(f)
+        identity = (os.path.abspath(f), stat.st_mtime_ns, stat.st_size, sorted(params.items()))
+        return hashlib.sha1(repr(identity).encode()).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            s = np.load(path, mmap_mode=self.mmap_mode)
+        except (FileNotFoundError, ValueError):
+            return None
+        # the modification time is what evict uses to order entries
+        os.utime(path)
+        return s
+
+    def put(self, key, s):
+        path = self.get_path(key)
+        path_tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(path_tmp, "wb") as fh:
+            np.save(fh, s)
+        if self.max_bytes is None:
+            os.replace(path_tmp, path)
+            return
+        with self._lock:
+            # an entry written again (e.g., by another thread) replaces the old one rather than adding to it
+            try:
+                size_old = os.path.getsize(path)
+            except FileNotFoundError:
+                size_old = 0
+            os.replace(path_tmp, path)
+            if self._size is None:
+                self._size = self.size()
+            else:
+                self._size += os.path.getsize(path) - size_old
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def load(self, f, loader=None, **params):
+        loader = loader or load_audio
+        key = self.get_key(f, **params)
+        s = self.get(key)
+        if s is None:
+            s = loader(f, **params)
+            self.put(key, s)
+        return s
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(self.SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        with self._lock:
+            self._evict(max_bytes)
+
+    def _evict(self, max_bytes=None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self.entries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self._size = size
+
+    def clear(self):
+        self.evict(max_bytes=0)
+
+def get_audio_cache(cache):
+    if cache is None or isinstance(cache, AudioCache):
+        return cache
+    return AudioCache(cache)
+
 class Wav2Array(BaseEstimator, TransformerMixin):
+    """
+     Decodes audio files into a numpy array of signals.
+     sampling_rate=NATIVE keeps the rate of the files, otherwise clips are resampled with res_type 
+     (see librosa.resample, librosa's default when None) to sampling_rate, or 22050 Hz when it is None.
+     With NATIVE, the rate of the first clip is recorded as sampling_rate_ by fit, and transform resamples to it
+     the clips recorded at another rate; otherwise sampling_rate_ is the rate clips are decoded at.
+     n_jobs files are decoded at once, on threads, or on worker processes with backend="process" (scripts doing so
+     must run under an if __name__ == "__main__": guard, see MP_CONTEXT).
+     With chunk_size, transform returns a stream of chunks of clips; with prefetch too, up to prefetch chunks
+     are decoded on a background thread ahead of the steps consuming the stream (prefetch without chunk_size raises).
+     Clips are stacked as dtype, float32 by default, the precision librosa decodes at.
+    """
+
     def __init__(self, 
                  sampling_rate=None,
-                 mono=True
+                 mono=True,
+                 n_jobs=None,
+                 backend="thread",
+                 max_in_flight=None,
+                 cache=None,
+                 chunk_size=None,
+                 channels=None,
+                 res_type=None,
+                 prefetch=0,
+                 dtype="float32"
                  ):
         self.sampling_rate = sampling_rate
         self.mono = mono
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.channels = channels
+        self.res_type = res_type
+        self.prefetch = prefetch
+        self.dtype = dtype
 
-    def fit(self, root, y=None, **fit_params):
+    def check_prefetch(self):
+        if self.prefetch and not self.chunk_size:
+            raise ValueError(
+                f"prefetch={self.prefetch} decodes chunks ahead of the steps consuming them, so it needs chunk_size to be set")
+
+    def fit(self, X, y=None, **fit_params):
+        self.check_prefetch()
+        f = next(iter(X), None)
+        if f is None and self.sampling_rate == NATIVE:
+            self.sampling_rate_ = None
+        else:
+            self.sampling_rate_ = get_sampling_rate(f, self.sampling_rate)
         return self
 
     def transform(self, X, y=None, **fit_params):
-        def get_array(f):
-            if self.sampling_rate:
-                s, _ = lib.load(f, sr=self.sampling_rate, mono=self.mono)
-                return s
-            else:
-                s, _ = lib.load(f, mono=self.mono)
-                return s
+        self.check_prefetch()
+        sampling_rate = self.sampling_rate
+        if sampling_rate == NATIVE and getattr(self, "sampling_rate_", None) is not None:
+            # once fitted, clips recorded at another rate are resampled to the rate the features are computed at
+            sampling_rate = self.sampling_rate_
+        params = {
+            "sampling_rate": sampling_rate,
+            "mono": self.mono,
+            "channels": self.channels,
+            "res_type": self.res_type,
+        }
+        cache = get_audio_cache(self.cache)
+        if cache is None:
+            get_array = partial(load_audio, **params)
+        else:
+            get_array = partial(cache.load, loader=load_audio, **params)
         np.random.seed(0)
-        Xt = np.array(list(map(get_array, X)))
+        arrays = ordered_map(
+            get_array, 
+            X, 
+            n_jobs=self.n_jobs, 
+            backend=self.backend, 
+            max_in_flight=self.max_in_flight
+            )
+        if self.chunk_size:
+            chunks = (stack_clips(chunk, dtype=self.dtype) for chunk in iter_chunks(arrays, self.chunk_size))
+            if self.prefetch:
+                chunks = prefetch(chunks, self.prefetch)
+            return chunks
+        Xt = stack_clips(arrays, n=len(X), dtype=self.dtype)
         return Xt
 
+def get_wav2array(pipeline):
+    """The wav2array step of pipeline, or of the pipeline wrapped by one of its steps (e.g., a FeatureCache)."""
+    if "wav2array" in pipeline.named_steps:
+        return pipeline.named_steps["wav2array"]
+    for _, step in pipeline.steps:
+        transformer = getattr(step, "transformer", None)
+        if hasattr(transformer, "named_steps") and "wav2array" in transformer.named_steps:
+            return transformer.named_steps["wav2array"]
+    return None
+
+def set_native_sampling_rate(pipeline, X):
+    """
+    Fits the wav2array step of pipeline and hands the sampling rate it decodes X at 
+    to the steps whose sampling_rate is NATIVE, so features are computed at the rate of the clips.
+    Steps wrapping a transformer (e.g., Chunkwise or FeatureCache) hand it down too.
+    """
+    wav2array = get_wav2array(pipeline)
+    if wav2array is None or wav2array.sampling_rate != NATIVE:
+        return pipeline
+    sampling_rate = wav2array.fit(X).sampling_rate_
+    for name, step in pipeline.steps:
+        if name == "wav2array" or not hasattr(step, "get_params"):
+            continue
+        params = step.get_params(deep=True)
+        native = {
+            param: sampling_rate for param, value in params.items() 
+            if param.split("__")[-1] == "sampling_rate" and isinstance(value, str) and value == NATIVE
+            # a wrapped wav2array keeps decoding at the native rate
+            and not param.endswith("wav2array__sampling_rate")
+            }
+        step.set_params(**native)
+    return pipeline
+
 class Demux2Array(BaseEstimator, TransformerMixin):
     def __init__(self, 
                  channel=0
@@ -36,6 +456,7 @@ class Demux2Array(BaseEstimator, TransformerMixin):
     def fit(self, root, y=None, **fit_params):
         return self
 
+    @stream_transform
     def transform(self, X, y=None, **fit_params):
         def get_array(Xi):
             # multi_channel_data, sr = file_load(wav_name)
@@ -43,9 +464,85 @@ class Demux2Array(BaseEstimator, TransformerMixin):
                 return Xi
             return np.array(Xi)[self.channel, :]
         
-        Xt = np.array(list(map(get_array, X)))
+        if isinstance(X, RaggedArray):
+            if X.data.ndim <= 1:
+                return X
+            return RaggedArray(X.data[self.channel], X.offsets)
+        if isinstance(X, np.ndarray) and X.dtype != object:
+            if X.ndim <= 2:
+                return X
+            return np.ascontiguousarray(X[:, self.channel, :])
+        Xt = stack_clips(map(get_array, X), n=len(X))
         return Xt
 
+class Stream2Array(BaseEstimator, TransformerMixin):
+    """
+     Concatenates the chunks of a stream into one array. Anything else is passed through.
+    """
+
+    def fit(self, X, y=None, **fit_params):
+        return self
+
+    def transform(self, X, y=None, **fit_params):
+        if not is_stream(X):
+            return X
+        Xt = concatenate_clips(X)
+        return Xt
+
+# attributes sklearn sets on any fitted estimator, from the shape of the input only
+INPUT_ATTRIBUTES = ("n_features_in_", "feature_names_in_")
+
+def get_fitted_attributes(estimator):
+    """Attributes learned at fit (e.g., edges_) by an estimator or by its nested estimators."""
+    estimators = [estimator] + [v for v in estimator.get_params(deep=True).values() if hasattr(v, "get_params")]
+    return sorted({
+        name for e in estimators for name in vars(e)
+        if name.endswith("_") and not name.startswith("_") and name not in INPUT_ATTRIBUTES
+        })
+
+class Chunkwise(BaseEstimator, TransformerMixin):
+    """
+     Applies a transformer to each chunk of a stream, e.g. a FeatureUnion, which would otherwise
+     hand the same stream to each of its transformers. On a stream, only the first chunk would reach fit,
+     so the transformer must be stateless: one that learns attributes at fit raises a ValueError.
+    """
+
+    def __init__(self, transformer):
+        self.transformer = transformer
+
+    def check_stateless(self):
+        attributes = get_fitted_attributes(self.transformer)
+        if attributes:
+            raise ValueError(
+                f"Chunkwise fits on the first chunk of a stream only, but the transformer learns {', '.join(attributes)} at fit. "
+                "Fit it without chunks."
+                )
+
+    def fit(self, X, y=None, **fit_params):
+        if not is_stream(X):
+            self.transformer.fit(X, **fit_params)
+            return self
+        self.transformer.fit(next(X), **fit_params)
+        self.check_stateless()
+        return self
+
+    def fit_transform(self, X, y=None, **fit_params):
+        if not is_stream(X):
+            return self.transformer.fit_transform(X, **fit_params)
+        def fit_transform_stream():
+            for i, chunk in enumerate(X):
+                if i == 0:
+                    Xt = self.transformer.fit_transform(chunk, **fit_params)
+                    self.check_stateless()
+                    yield Xt
+                else:
+                    yield self.transformer.transform(chunk)
+        return fit_transform_stream()
+
+    @stream_transform
+    def transform(self, X, y=None, **fit_params):
+        return self.transformer.transform(X)
+
 from sklearn.model_selection import BaseShuffleSplit
 from sklearn.utils.validation import check_random_state 
 from sklearn.model_selection._split import _validate_shuffle_split
@@ -81,8 +578,10 @@ class AbnormalSplit(BaseShuffleSplit):
 import os
 import glob
 # from functools import reduce
-def get_files_from_path(path):
+def get_files_from_path(path, manifest=None):
     pattern = "*.wav"
+    if manifest is not None:
+        return manifest.get_files(path, pattern)
     path_wav = lambda signal_class: glob.glob(os.path.join(path, signal_class, pattern))
     return path_wav(path)
 
@@ -93,20 +592,20 @@ def get_X_y_from_normal_abnormal(normal, abnormal):
     y = np.concatenate([y0, y1])
     return X, y
     
-def get_files_from_path_classes(path):
-    X0 = get_files_from_path(os.path.join(path, "normal"))
-    X1 = get_files_from_path(os.path.join(path, "abnormal"))
+def get_files_from_path_classes(path, manifest=None):
+    X0 = get_files_from_path(os.path.join(path, "normal"), manifest)
+    X1 = get_files_from_path(os.path.join(path, "abnormal"), manifest)
     X, y = get_X_y_from_normal_abnormal(X0, X1)
     return X, y
 
 
-def files_train_test_split(path, random_state=None):
-    X, y = get_files_from_path_classes(path)
+def files_train_test_split(path, random_state=None, manifest=None):
+    X, y = get_files_from_path_classes(path, manifest)
     ind_train, ind_test = next(AbnormalSplit(random_state=random_state,n_splits=1).split(X, y))
     X_train, X_test, y_train, y_test = X[ind_train], X[ind_test], y[ind_train], y[ind_test]
     return X_train, X_test, y_train, y_test
 
-def files_train_test_split_dcase2020_task2(path, pattern=''):
+def files_train_test_split_dcase2020_task2(path, pattern='', manifest=None):
     """
     class_id_sample.wav
     
@@ -114,12 +613,16 @@ def files_train_test_split_dcase2020_task2(path, pattern=''):
     normal_id_00_00000110.wav
      
     """
+    if manifest is not None:
+        get_files = lambda split, signal_class: manifest.get_files(os.path.join(path, split), f'{signal_class}_{pattern}*')
+    else:
+        get_files = lambda split, signal_class: glob.glob(os.path.join(path, split, f'{signal_class}_{pattern}*'))
     
-    X_train_normal = glob.glob(os.path.join(path, 'train', f'normal_{pattern}*'))
-    X_train_abnormal = glob.glob(os.path.join(path, 'train', f'anomaly_{pattern}*'))
+    X_train_normal = get_files('train', 'normal')
+    X_train_abnormal = get_files('train', 'anomaly')
     
-    X_test_abnormal = glob.glob(os.path.join(path, 'test', f'anomaly_{pattern}*'))
-    X_test_normal = glob.glob(os.path.join(path, 'test', f'normal_{pattern}*'))
+    X_test_abnormal = get_files('test', 'anomaly')
+    X_test_normal = get_files('test', 'normal')
     
     X_train, y_train = get_X_y_from_normal_abnormal(X_train_normal, X_train_abnormal)
     X_test, y_test = get_X_y_from_normal_abnormal(X_test_normal, X_test_abnormal)
@@ -127,12 +630,12 @@ def files_train_test_split_dcase2020_task2(path, pattern=''):
     return X_train, X_test, y_train, y_test
 
 
-def files_train_test_split_combined(paths):
+def files_train_test_split_combined(paths, manifest=None):
     def reduce_data(d1, d2):
         data = zip(d1, d2)
         data = list(data)
         X_train, X_test, y_train, y_test = [np.concatenate([d1, d2]) for (d1,d2) in data]
         return X_train, X_test, y_train, y_test
-    data = list(map(files_train_test_split, paths))
+    data = list(map(partial(files_train_test_split, manifest=manifest), paths))
     X_train, X_test, y_train, y_test = reduce(reduce_data, data)
     return X_train, X_test, y_train, y_test
\ No newline at end of file
@@ -20,6 +20,7 @@ import itertools as ite
 from functools import reduce
 from mtsa import (
     MFCCMix,
+    MFCCMixSubsets,
     Hitachi,
     FEATURES,
     files_train_test_split,
@@ -33,6 +34,7 @@ from functools import partial
 from mtsa.metrics import calculate_aucroc
 from mtsa.common import elapsed_time
 from mtsa.utils import files_train_test_split
+from mtsa.manifest import Manifest
 from apache_beam.io import WriteToText
 from apache_beam.pipeline import PipelineOptions
 import apache_beam as beam
@@ -41,16 +43,22 @@ import argparse
 from mtsa import get_tsne_results
 
 
+def load_manifest(path):
+    return Manifest.load(path) if path else None
+
 class IndividualCreateKeyFn(beam.DoFn):
     def __init__(self, *args, **kwargs) -> None:
         beam.DoFn.__init__(self)
         self.__dict__.update(kwargs)
 
+    def setup(self):
+        self.files_manifest = load_manifest(self.manifest)
+
     def process(self, args):
         model_name, model = args
         all_paths = glob.glob(os.path.join(self.path, f'*{os.sep}' * self.level))
         for path in all_paths:
-            X_train, X_test, y_train, y_test = files_train_test_split(path)
+            X_train, X_test, y_train, y_test = files_train_test_split(path, manifest=self.files_manifest)
             metrics = []
             yield (path, model_name, model, X_train, X_test, y_train, y_test, metrics)
 
@@ -59,6 +67,9 @@ class CombinedCreateKeyFn(beam.DoFn):
         beam.DoFn.__init__(self)
         self.__dict__.update(kwargs)
 
+    def setup(self):
+        self.files_manifest = load_manifest(self.manifest)
+
     def process(self, args):
         model_name, model = args
         all_paths = glob.glob(os.path.join(self.path, f'*{os.sep}' * (self.level - 1)))
@@ -69,8 +80,8 @@ class CombinedCreateKeyFn(beam.DoFn):
             for split in splits:
                 path_train = paths[split[0]]
                 path_test = paths[split[1]]
-                train_X_train, train_X_test, train_y_train, train_y_test = files_train_test_split_combined(path_train)
-                test_X_train, test_X_test, test_y_train, test_y_test = files_train_test_split_combined(path_test)
+                train_X_train, train_X_test, train_y_train, train_y_test = files_train_test_split_combined(path_train, manifest=self.files_manifest)
+                test_X_train, test_X_test, test_y_train, test_y_test = files_train_test_split_combined(path_test, manifest=self.files_manifest)
                 metrics = []
                 yield (path_test[0], model_name, model, train_X_train, test_X_test, train_y_train, test_y_test, metrics)
 
@@ -89,6 +100,20 @@ class FitFn(beam.DoFn):
         )
         yield (path, model_name, model, X_train, X_test, y_train, y_test, metrics)
 
+class SplitSubsetsFn(beam.DoFn):
+    """Turns a fitted MFCCMixSubsets into the MFCCMix of each subset, which share its features."""
+    def __init__(self, *args, **kwargs) -> None:
+        beam.DoFn.__init__(self)
+        self.__dict__.update(kwargs)
+
+    def process(self, element):
+        path, model_name, model, X_train, X_test, y_train, y_test, metrics = element
+        if not isinstance(model, MFCCMixSubsets):
+            yield element
+            return
+        for subset_name, subset_model in model.get_models():
+            yield (path, subset_name, subset_model, X_train, X_test, y_train, y_test, list(metrics))
+
 class RocFn(beam.DoFn):
     def __init__(self, *args, **kwargs) -> None:
         beam.DoFn.__init__(self)
@@ -140,7 +165,7 @@ class TransformFn(beam.DoFn):
             "tsnes": tsnes
         }
 
-def get_models_mfccmix(n_components):
+def get_models_mfccmix(n_components, cache=None, feature_cache=None):
     def get_features():
         number_features = np.arange(1, len(FEATURES)+1)
         def combinations(r): return ite.combinations(FEATURES, r)
@@ -151,7 +176,9 @@ def get_models_mfccmix(n_components):
     def build_mfccmix_by_features(features):
         mfccmix = MFCCMix(
             features=list(features),
-            final_model=GaussianMixture(n_components=n_components)
+            final_model=GaussianMixture(n_components=n_components),
+            cache=cache,
+            feature_cache=feature_cache
         )
         return "MFCCMix " + "+".join([f[0] for f in features]), mfccmix
     
@@ -160,10 +187,22 @@ def get_models_mfccmix(n_components):
     return mfcc_models
 
 
-def get_models(n_components):
-    models_hitachi = [("Hitachi", Hitachi())]
-    # models_mfccmix = get_models_mfccmix(n_components)
+def get_models_mfccmix_subsets(n_components, cache=None, feature_cache=None):
+    # one model computing the features once for all the subsets, split by SplitSubsetsFn once fitted
+    mfccmix = MFCCMixSubsets(
+        final_model=GaussianMixture(n_components=n_components),
+        cache=cache,
+        feature_cache=feature_cache
+    )
+    return [(mfccmix.name, mfccmix)]
+
+
+def get_models(n_components, cache=None, feature_cache=None, subsets=False):
+    models_hitachi = [("Hitachi", Hitachi(cache=cache, feature_cache=feature_cache))]
+    # models_mfccmix = get_models_mfccmix(n_components, cache, feature_cache)
     models_mfccmix = []
+    if subsets:
+        models_mfccmix = get_models_mfccmix_subsets(n_components, cache, feature_cache)
     all_models = reduce(lambda x, y: ite.chain(
         x, y), (models_hitachi, models_mfccmix))
     return list(all_models)
@@ -178,12 +217,14 @@ def run_pipeline(known_args):
 
     with beam.Pipeline() as pipeline:
 
-        models = pipeline | "models" >> beam.Create(known_args.runs * get_models(known_args.n_components))
+        models = pipeline | "models" >> beam.Create(known_args.runs * get_models(known_args.n_components, known_args.cache, known_args.feature_cache, known_args.subsets))
 
-        keys = models | "keys" >> beam.ParDo(create_key_fn(path=known_args.path, level=known_args.level))
+        keys = models | "keys" >> beam.ParDo(create_key_fn(path=known_args.path, level=known_args.level, manifest=known_args.manifest))
 
         fits = keys | "train" >> beam.ParDo(FitFn())
 
+        fits = fits | "subsets" >> beam.ParDo(SplitSubsetsFn())
+
         rocs = fits | "test" >> beam.ParDo(RocFn())
         
         tsnes = rocs | "tsne" >> beam.ParDo(TSNEFn())
@@ -204,6 +245,10 @@ def main(argv=None):
     parser.add_argument('--runs', type=int, required=True)
     parser.add_argument('--n_components', type=int, required=True)
     parser.add_argument('--sampling_rate', type=int)
+    parser.add_argument('--cache', type=str)
+    parser.add_argument('--manifest', type=str)
+    parser.add_argument('--feature_cache', type=str)
+    parser.add_argument('--subsets', action='store_true')
     # parser.add_argument('--perplexity', type=int)
 
     known_args, pipeline_args = parser.parse_known_args(argv)
@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+import scipy.stats as st
+from mtsa.correlation_networks import rank
+
+@pytest.mark.parametrize("shape", [(1,), (7,), (3, 50), (2, 4, 33)])
+@pytest.mark.parametrize("n_values", [2, 5, None])
+def test_rank_matches_rankdata(shape, n_values):
+    rng = np.random.default_rng(0)
+    # few distinct values give long runs of ties, None gives none
+    X = rng.standard_normal(shape) if n_values is None else rng.integers(0, n_values, shape).astype(np.float64)
+    np.testing.assert_array_equal(rank(X), st.rankdata(X, axis=-1))
+
+def test_rank_of_constant_rows():
+    X = np.ones((3, 10))
+    np.testing.assert_array_equal(rank(X), np.full((3, 10), 5.5))
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from mtsa.correlation_networks import RollingCorrelationNetwork, get_triu
+
+N_FEATURES = 20
+N_FRAMES = 3000
+
+def get_expected(X, window, step):
+    return np.array([get_triu(np.corrcoef(X[:, start:start + window])) for start in range(0, X.shape[1] - window + 1, step)])
+
+def push_chunks(network, X, chunk_sizes):
+    bounds = np.concatenate([[0], np.cumsum(chunk_sizes)])
+    return np.concatenate([network.push(X[:, start:end]) for start, end in zip(bounds[:-1], bounds[1:])])
+
+def get_chunk_sizes(kind, rng):
+    if kind == "whole":
+        return [N_FRAMES]
+    if kind == "frames":
+        return [1] * N_FRAMES
+    # random sizes, empty chunks included
+    sizes = rng.integers(0, 700, 40)
+    sizes = sizes[np.cumsum(sizes) < N_FRAMES]
+    return list(sizes) + [N_FRAMES - sizes.sum()]
+
+@pytest.mark.parametrize("window, step", [(50, 1), (64, 7), (500, 3)])
+@pytest.mark.parametrize("kind", ["whole", "frames", "random"])
+def test_rolling_correlation_network_matches_corrcoef(window, step, kind):
+    rng = np.random.default_rng(0)
+    # an offset far from zero, as mfccs, would show a badly conditioned running sum
+    X = rng.standard_normal((N_FEATURES, N_FRAMES)) * 50 + 300
+    features = push_chunks(RollingCorrelationNetwork(window, step), X, get_chunk_sizes(kind, rng))
+    expected = get_expected(X, window, step)
+    assert features.shape == expected.shape
+    np.testing.assert_allclose(features, expected, atol=1e-8)
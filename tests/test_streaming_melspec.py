@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from mtsa.features.mel import Array2MelSpec, StreamingMelSpec
+
+SAMPLING_RATE = 16000
+
+def get_array2melspec():
+    return Array2MelSpec(sampling_rate=SAMPLING_RATE, n_fft=1024, hop_length=512, n_mels=64, frames=5, power=2.0)
+
+@pytest.mark.parametrize("push_size", [1, 100, 511, 512, 1024, 4000, 2 * SAMPLING_RATE])
+def test_streaming_melspec_matches_array2melspec(push_size):
+    rng = np.random.default_rng(0)
+    clip = rng.standard_normal(2 * SAMPLING_RATE).astype(np.float32)
+    array2melspec = get_array2melspec().fit(clip[np.newaxis])
+    expected = array2melspec.transform(clip[np.newaxis])
+
+    streaming = StreamingMelSpec.from_transformer(array2melspec)
+    vectors = [streaming.push(clip[start:start + push_size]) for start in range(0, len(clip), push_size)]
+    vectors.append(streaming.flush())
+    vectors = np.concatenate(vectors)
+    assert vectors.shape == expected.shape
+    # log mel energies in dB, up to the order BLAS sums the mel filterbank product in
+    np.testing.assert_allclose(vectors, expected, rtol=1e-5, atol=1e-4)
+
+def test_streaming_melspec_flush_starts_a_new_stream():
+    rng = np.random.default_rng(1)
+    clip = rng.standard_normal(SAMPLING_RATE).astype(np.float32)
+    array2melspec = get_array2melspec().fit(clip[np.newaxis])
+    streaming = StreamingMelSpec.from_transformer(array2melspec)
+    first = np.concatenate([streaming.push(clip), streaming.flush()])
+    second = np.concatenate([streaming.push(clip), streaming.flush()])
+    np.testing.assert_array_equal(first, second)